@@ -0,0 +1,4 @@
+from uwlink import create_app
+
+# Async serving mode, see uwlink/asgi.py
+app = create_app(asgi=True)
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from bson.objectid import ObjectId
+from werkzeug.datastructures import MultiDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import data  # noqa: E402
+from uwlink import create_app  # noqa: E402
+from uwlink.loaders import load_event_page, load_joined_page  # noqa: E402
+from uwlink.models import User, Event, Membership, Tag, Counter, DayCount  # noqa: E402
+from uwlink.search import SearchQuery  # noqa: E402
+
+# Checks the async serving mode (uwlink/asgi.py) against a local mongod
+#
+# Motor needs a real MongoDB server, so unlike bench/run.py this can't use mongomock. The database is filled with a
+# little synthetic data from bench/data.py, and then messages are sent straight to the ASGI app, the way uvicorn would:
+# the lifespan startup, a request to each /async/ endpoint and one to a Flask page, and the lifespan shutdown. Every
+# /async/ response is compared with what the Flask app's own queries return, and the script stops with an error at the
+# first difference:
+#
+#   python bench/asgi_check.py --host mongodb://localhost:27017/uwlink-asgi-check --reset
+#
+# https://asgi.readthedocs.io/en/latest/specs/www.html
+# https://asgi.readthedocs.io/en/latest/specs/lifespan.html
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise CheckFailed(message.format(*args))
+
+
+# Sends one GET request to the app. Returns the status and the body
+async def get(app, path, query_string=''):
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': query_string.encode(), 'root_path': '',
+             'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 0), 'server': ('localhost', 80)}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    expect(sent and sent[0]['type'] == 'http.response.start', 'GET {} sent no response', path)
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+async def get_json(app, path, query_string=''):
+    status, body = await get(app, path, query_string)
+    expect(status == 200, 'GET {}?{} returned {}', path, query_string, status)
+    return json.loads(body)
+
+
+# Runs the app's lifespan, and returns a function that shuts it down
+async def start(app):
+    incoming = asyncio.Queue()
+    outgoing = asyncio.Queue()
+    task = asyncio.ensure_future(app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, incoming.get, outgoing.put))
+    await incoming.put({'type': 'lifespan.startup'})
+    message = await asyncio.wait_for(outgoing.get(), 5)
+    expect(message['type'] == 'lifespan.startup.complete', 'Startup answered {}', message)
+
+    async def stop():
+        await incoming.put({'type': 'lifespan.shutdown'})
+        message = await asyncio.wait_for(outgoing.get(), 5)
+        expect(message['type'] == 'lifespan.shutdown.complete', 'Shutdown answered {}', message)
+        await asyncio.wait_for(task, 5)
+
+    return stop
+
+
+def _ids(events):
+    return [event['event_id'] for event in events]
+
+
+async def check(app, flask_app):
+    with flask_app.app_context():
+        newest = [str(event.id) for event in Event.objects.order_by('-created_at', '-id').only('id')[:9]]
+        user = User.objects.get(username='user0')
+        created = [str(event.id) for event in load_event_page(user.events_created, 1, app.profile_per_page)]
+        joined = [str(event.id) for event in load_joined_page(user.id, 1, app.profile_per_page)]
+        tag = data.TAGS[0]
+        tagged = Event._get_collection().count_documents(SearchQuery.from_args(MultiDict({'tags': tag})).to_mongo())
+
+    feed = await get_json(app, '/async/feed')
+    expect(_ids(feed['events']) == newest[:app.feed_per_page], 'The feed has the wrong events')
+    older = await get_json(app, '/async/feed', 'before=' + feed['older'])
+    expect(_ids(older['events'])[:1] == newest[app.feed_per_page:], 'The next page of the feed has the wrong events')
+
+    result = await get_json(app, '/async/result', 'tags=' + tag)
+    expect(result['count'] == tagged, 'Searching for {} found {} events instead of {}', tag, result['count'], tagged)
+    expect(all(tag in event['tags'] for event in result['events']), 'Search results without the tag {}', tag)
+
+    profile = await get_json(app, '/async/profile/user0')
+    expect(profile['user']['username'] == 'user0', 'The profile is of {}', profile['user']['username'])
+    expect(_ids(profile['events_created']) == created, 'The profile has the wrong created events')
+    expect(_ids(profile['events_joined']) == joined, 'The profile has the wrong joined events')
+    expect(all(ObjectId.is_valid(event_id) for event_id in _ids(profile['events_joined'])), 'Invalid event ids')
+
+    status, _ = await get(app, '/async/profile/nobody')
+    expect(status == 404, 'An unknown profile returned {}', status)
+    status, _ = await get(app, '/async/nothing')
+    expect(status == 404, 'An unknown /async/ path returned {}', status)
+    # Every other path is served by Flask
+    status, _ = await get(app, '/')
+    expect(status == 200, 'The Flask feed returned {}', status)
+
+
+async def run(app, flask_app):
+    stop = await start(app)
+    try:
+        await check(app, flask_app)
+    finally:
+        await stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the async serving mode against a local mongod.')
+    parser.add_argument('--host', default='mongodb://localhost:27017/uwlink-asgi-check', help='MongoDB URI.')
+    parser.add_argument('--reset', action='store_true', help='Drop the existing data in the database first.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--events', type=int, default=200)
+    args = parser.parse_args()
+    if args.host.startswith('mongomock://'):
+        parser.error('Motor needs a real MongoDB server')
+
+    app = create_app({'MONGODB_HOST': args.host,
+                      'TESTING': True,
+                      'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1',
+                      'ADMISSION_ENABLED': False}, asgi=True)
+    flask_app = app.flask_app
+    with flask_app.app_context():
+        if Event.objects.count() or User.objects.count():
+            if not args.reset:
+                parser.error('{} already has data, pass --reset to drop it'.format(args.host))
+            for document_class in (User, Event, Membership, Tag, Counter, DayCount):
+                document_class.drop_collection()
+                document_class.ensure_indexes()
+        data.load(args.users, args.events)
+
+    try:
+        asyncio.run(run(app, flask_app))
+    except CheckFailed as e:
+        sys.exit('Failed: {}'.format(e))
+    print('The async mode works against {}'.format(args.host.split('@')[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import itertools
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+from uwlink import bulk
+
+# Synthetic data for the benchmarks in bench/run.py
+#
+# The data is shaped roughly like the real thing: a few tags are used by most events and most tags are rare, most events
+# have a handful of participants and a few have hundreds, and some users create and join far more events than others.
+# The same seed always generates the same data, so runs can be compared
+#
+# Everything is loaded with the bulk importer from uwlink/bulk.py, so users' events_created, the memberships and the tag
+# counts are filled in the same way as for real data
+
+WORDS = ('board', 'games', 'study', 'group', 'soccer', 'pickup', 'basketball', 'hackathon', 'movie', 'night', 'chess',
+         'club', 'math', 'midterm', 'review', 'coffee', 'chat', 'hiking', 'trip', 'volleyball', 'tournament', 'side',
+         'project', 'piano', 'jam', 'session', 'smash', 'bros', 'league', 'ramen', 'run', 'resume', 'workshop', 'poker',
+         'karaoke', 'climbing', 'yoga', 'badminton', 'cooking', 'photography', 'walk', 'trivia', 'debate', 'lunch')
+TAGS = ('games', 'sports', 'study', 'social', 'music', 'food', 'outdoors', 'tech', 'art', 'fitness', 'cs', 'math',
+        'ece', 'chem', 'phys', 'bio', 'econ', 'film', 'books', 'chess', 'anime', 'dance', 'coop', 'startup')
+# Every user's password is PASSWORD, hashed with a single iteration so that generating users is quick
+PASSWORD = 'bench'
+PASSWORD_HASH = generate_password_hash(PASSWORD, 'pbkdf2:sha256:1')
+
+
+# Returns a function picking k items from population with a Zipf-like skew: the first items are much more likely than
+# the last ones
+def _skewed(rng, population, exponent=1.1):
+    cum_weights = list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, len(population) + 1)))
+    return lambda k=1: rng.choices(population, cum_weights=cum_weights, k=k)
+
+
+def users(count):
+    for i in range(count):
+        yield {'username': 'user{}'.format(i),
+               'email': 'user{}@uwaterloo.ca'.format(i),
+               'hashed_password': PASSWORD_HASH}
+
+
+def events(count, user_count, seed=0, max_participants=300):
+    rng = random.Random(seed)
+    pick_user = _skewed(rng, ['user{}'.format(i) for i in range(user_count)])
+    pick_tags = _skewed(rng, TAGS)
+    now = datetime.now()
+    for i in range(count):
+        creator = pick_user()[0]
+        # Most events have a few participants, a handful are very popular
+        participant_count = min(int(rng.paretovariate(1.2)) - 1, max_participants, user_count - 1)
+        participants = set(pick_user(participant_count))
+        participants.discard(creator)
+        yield {'name': ' '.join(rng.sample(WORDS, rng.randint(1, 4))).title(),
+               'description': ' '.join(rng.choices(WORDS, k=rng.randint(5, 40))),
+               'tags': sorted(set(pick_tags(rng.randint(0, 4)))),
+               'time': now + timedelta(days=rng.uniform(-60, 60)),
+               'creator': creator,
+               'participants': sorted(participants),
+               'created_at': now - timedelta(days=60) + timedelta(seconds=i)}
+
+
+def load(user_count, event_count, seed=0, batch_size=1000):
+    bulk.import_users(users(user_count), batch_size)
+    return bulk.import_events(events(event_count, user_count, seed), batch_size)
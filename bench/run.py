@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import data  # noqa: E402
+from uwlink import create_app  # noqa: E402
+from uwlink.models import User, Event, Membership, Tag, Counter, DayCount  # noqa: E402
+
+# Benchmarks for the routes in uwlink/routes.py
+#
+# The app is created with its database pointed at an in-memory stand-in (mongomock, the default) or a local mongod,
+# filled with synthetic data from bench/data.py, and then every scenario below is run through the Flask test client:
+#
+#   python bench/run.py --users 2000 --events 20000
+#   python bench/run.py --host mongodb://localhost:27017/uwlink-bench --reset --compare bench/results/<earlier run>.json
+#
+# For each scenario the latency (p50/p99), the number of MongoDB commands per request and the peak memory allocated
+# during a request are reported, and everything is saved to bench/results/ so that runs can be compared with --compare.
+# mongomock runs in the same process and doesn't go through pymongo, so it has no query counts. Requests that fail are
+# counted as errors instead of stopping the run. Latencies against mongomock are only comparable with other mongomock
+# runs
+#
+# https://docs.mongodb.com/manual/reference/program/mongod/
+# https://github.com/mongomock/mongomock
+# https://pymongo.readthedocs.io/en/stable/api/pymongo/monitoring.html
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+# Counts the commands sent to MongoDB. Listeners have to be registered before the client is created
+class QueryCounter(monitoring.CommandListener):
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class Context:
+    def __init__(self, app, rng, usernames, event_ids, own_event_ids):
+        self.rng = rng
+        self.usernames = usernames
+        self.event_ids = event_ids
+        self.own_event_ids = own_event_ids
+        self.anonymous = app.test_client()
+        # The most active user, who has created the most events
+        self.user = app.test_client()
+        self.user.post('/login', data={'loginUser': usernames[0], 'loginPassword': data.PASSWORD})
+
+    def word(self):
+        return self.rng.choice(data.WORDS)
+
+
+def feed(context):
+    return context.anonymous.get('/')
+
+
+def feed_deep(context):
+    return context.anonymous.get('/?page={}'.format(context.rng.randint(2, 50)))
+
+
+def feed_logged_in(context):
+    return context.user.get('/')
+
+
+def result(context):
+    return context.anonymous.get('/result', query_string={'name': context.word(), 'past': '1'})
+
+
+def result_tags(context):
+    tags = ' '.join(context.rng.sample(data.TAGS[:8], 2))
+    return context.anonymous.get('/result', query_string={'tags': tags, 'past': '1',
+                                                          'page': context.rng.randint(1, 5)})
+
+
+def profile(context):
+    return context.anonymous.get('/profile/{}'.format(context.rng.choice(context.usernames[:50])))
+
+
+def join_leave(context):
+    event_id = context.rng.choice(context.event_ids)
+    headers = {'Accept': 'application/json'}
+    response = context.user.post('/join', data={'event_id': event_id}, headers=headers)
+    if response.status_code >= 400:
+        return response
+    return context.user.post('/leave', data={'event_id': event_id}, headers=headers)
+
+
+# Event times in the synthetic data are within 60 days of now
+def calendar(context):
+    day = datetime.now() + timedelta(days=context.rng.randint(-60, 60))
+    query_string = {'day': day.strftime('%Y-%m-%d')}
+    if context.rng.random() < 0.5:
+        query_string['view'] = 'week'
+    return context.anonymous.get('/calendar', query_string=query_string)
+
+
+def delete(context):
+    if not context.own_event_ids:
+        raise RuntimeError('No events left to delete')
+    return context.user.post('/delete', data={'event_id': context.own_event_ids.pop()})
+
+
+SCENARIOS = {
+    'feed': feed,
+    'feed_deep': feed_deep,
+    'feed_logged_in': feed_logged_in,
+    'result': result,
+    'result_tags': result_tags,
+    'profile': profile,
+    'join_leave': join_leave,
+    'calendar': calendar,
+    'delete': delete
+}
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _call(scenario, context):
+    response = scenario(context)
+    if response.status_code >= 400:
+        raise RuntimeError('HTTP {}'.format(response.status_code))
+
+
+def run_scenario(scenario, context, counter, requests, memory_requests):
+    latencies = []
+    queries = []
+    errors = []
+    for _ in range(requests):
+        counter.count = 0
+        started = time.perf_counter()
+        try:
+            _call(scenario, context)
+        except Exception as e:
+            errors.append('{}: {}'.format(type(e).__name__, e))
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(counter.count)
+
+    # Memory is measured in a separate pass, since tracing allocations slows everything down
+    peaks = []
+    tracemalloc.start()
+    for _ in range(memory_requests):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            _call(scenario, context)
+        except Exception:
+            continue
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'queries_per_request': sum(queries) / len(queries) if queries and counter.enabled else None,
+        'peak_kib': max(peaks) / 1024 if peaks else None
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(RESULTS_DIR)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format(value, unit=''):
+    return '-' if value is None else '{:.2f}{}'.format(value, unit)
+
+
+def _change(new, old):
+    if new is None or not old:
+        return ''
+    return ' ({:+.0f}%)'.format((new - old) / old * 100)
+
+
+def report(results, previous=None):
+    previous = previous['scenarios'] if previous else {}
+    print('{:<16} {:>8} {:>20} {:>20} {:>10} {:>12} {:>7}'.format(
+        'scenario', 'requests', 'p50', 'p99', 'queries', 'peak', 'errors'))
+    for name, stats in results['scenarios'].items():
+        old = previous.get(name, {})
+        print('{:<16} {:>8} {:>20} {:>20} {:>10} {:>12} {:>7}'.format(
+            name, stats['requests'],
+            _format(stats['p50_ms'], 'ms') + _change(stats['p50_ms'], old.get('p50_ms')),
+            _format(stats['p99_ms'], 'ms') + _change(stats['p99_ms'], old.get('p99_ms')),
+            _format(stats['queries_per_request']),
+            _format(stats['peak_kib'], 'KiB'),
+            stats['errors']))
+        if stats['first_error']:
+            print('    {}'.format(stats['first_error']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the UW Link routes against synthetic data.')
+    parser.add_argument('--host', default='mongomock://localhost/uwlink-bench',
+                        help='MongoDB URI, mongomock:// for an in-memory database.')
+    parser.add_argument('--reset', action='store_true', help='Drop the existing data in the database first.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario.')
+    parser.add_argument('--memory-requests', type=int, default=20,
+                        help='Requests per scenario traced for memory use.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Only run these scenarios (can be repeated).')
+    parser.add_argument('--output', help='Where to save the results, by default bench/results/<time>.json.')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    counter = QueryCounter(enabled=not args.host.startswith('mongomock://'))
+    monitoring.register(counter)
+    app = create_app({'MONGODB_HOST': args.host,
+                      'TESTING': True,
+                      'WTF_CSRF_ENABLED': False,
+                      'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1',
+                      # Every benchmark request comes from the same client, which would soon be rate limited
+                      'ADMISSION_ENABLED': False})
+
+    with app.app_context():
+        if Event.objects.count() or User.objects.count():
+            if not args.reset:
+                parser.error('{} already has data, pass --reset to drop it'.format(args.host))
+            for document_class in (User, Event, Membership, Tag, Counter, DayCount):
+                document_class.drop_collection()
+                document_class.ensure_indexes()
+        started = time.perf_counter()
+        data.load(args.users, args.events, args.seed)
+        print('Loaded {} users and {} events in {:.1f}s'.format(args.users, args.events,
+                                                               time.perf_counter() - started))
+        usernames = ['user{}'.format(i) for i in range(args.users)]
+        event_ids = [str(event_id) for event_id in Event.objects.distinct('id')]
+        own_event_ids = [str(event.id) for event in Event.objects(creator=usernames[0]).only('id')]
+
+    rng = random.Random(args.seed)
+    context = Context(app, rng, usernames, event_ids, own_event_ids)
+    results = {
+        'started_at': datetime.now().isoformat(),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'host': args.host.split('@')[-1],
+        'users': args.users,
+        'events': args.events,
+        'seed': args.seed,
+        'scenarios': {}
+    }
+    for name in args.scenario or SCENARIOS:
+        results['scenarios'][name] = run_scenario(SCENARIOS[name], context, counter, args.requests,
+                                                  args.memory_requests)
+    results['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    report(results, previous)
+
+    output = args.output or os.path.join(RESULTS_DIR, '{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('Saved results to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
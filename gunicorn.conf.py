@@ -0,0 +1,28 @@
+import os
+
+# gunicorn settings, read automatically when gunicorn is started from this directory (see Procfile)
+#
+# The app is created once in the master process and then forked, so the workers share its compiled templates and start
+# with the indexes already built (see preload in uwlink/config.py). Each worker then connects to MongoDB before it takes
+# its first request. WEB_CONCURRENCY (set by Heroku) is the number of workers, and GUNICORN_THREADS the number of
+# threads in each; the concurrency caps in uwlink/admission.py keep slow endpoints from using up all of a worker's
+# threads
+#
+# https://docs.gunicorn.org/en/stable/settings.html
+# https://devcenter.heroku.com/articles/python-gunicorn
+preload_app = True
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 30
+
+
+def when_ready(server):
+    from run import app
+    from uwlink import config
+
+    config.preload(app)
+
+
+def post_fork(server, worker):
+    from uwlink import config
+
+    config.warm_worker()
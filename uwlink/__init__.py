@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask
 from flask_mongoengine import MongoEngine
 from flask_bootstrap import Bootstrap
@@ -21,9 +23,10 @@ bootstrap = Bootstrap()
 login_manager = LoginManager()
 
 
-def create_app():
+# config overrides any of the settings below, e.g. create_app({'MONGODB_HOST': 'mongomock://localhost/uwlink'}) for an
+# in-memory database (see bench/). With asgi=True, the Flask app is wrapped in the async serving mode from uwlink/asgi.py
+def create_app(config=None, asgi=False):
     app = Flask(__name__)
-    app.debug = True
 
     # Configure Flask to connect to our MongoDB cluster
     #
@@ -31,21 +34,72 @@ def create_app():
     # environment variables or some other configuration service
     #
     # https://security.stackexchange.com/questions/184021/managing-db-credentials-for-web-applications
+    #
+    # Setting the MONGODB_HOST environment variable points the app at another database, e.g. a local mongod:
+    # MONGODB_HOST=mongodb://localhost:27017/uwlink
     mongo_username = 'admin'
     mongo_password = 'admin'
-    app.config['MONGODB_HOST'] = 'mongodb+srv://{}:{}@cluster0.ryror.mongodb.net/uwlink?retryWrites=true&w=majority'\
+    app.config['MONGODB_HOST'] = os.environ.get('MONGODB_HOST') or \
+        'mongodb+srv://{}:{}@cluster0.ryror.mongodb.net/uwlink?retryWrites=true&w=majority'\
         .format(mongo_username, mongo_password)
-    db.init_app(app)
-
-    bootstrap.init_app(app)
 
     # Like the DB credentials, this should not be harcoded
     #
     # This is used by Flask for various tasks, like signing cookies
-    app.config['SECRET_KEY'] = 'a super secret key'
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'a super secret key'
+
+    # Settings for the environment (development, production or testing) and the config argument, see uwlink/config.py
+    from uwlink import config as config_profiles
+    config_profiles.load(app, config)
+
+    # Count and time the queries and template rendering of each request, see uwlink/instrumentation.py. This has to be
+    # set up before the database connection
+    from uwlink import instrumentation
+    instrumentation.init_app(app)
+
+    # Rate limits and concurrency caps for the expensive endpoints, see uwlink/admission.py
+    from uwlink import admission
+    admission.init_app(app)
+
+    db.init_app(app)
+
+    bootstrap.init_app(app)
+
     login_manager.init_app(app)
 
+    # Password hashing settings, see uwlink/passwords.py
+    from uwlink import passwords
+    passwords.init_app(app)
+
+    # Cache users and events between requests and workers, see uwlink/document_cache.py
+    from uwlink import document_cache
+    document_cache.init_app(app)
+
+    # Deduplicate loads of the same document within a request, see uwlink/identity_map.py
+    from uwlink import identity_map
+    identity_map.init_app(app)
+
+    # Cache rendered event cards, see uwlink/fragments.py
+    from uwlink import fragments
+    fragments.init_app(app)
+
+    # Serve the fingerprinted and precompressed static files from `flask assets build`, see uwlink/assets.py
+    from uwlink import assets
+    assets.init_app(app)
+
     # Register the API endpoints we defined in uwlink/routes.py
     from uwlink.routes import routes
     app.register_blueprint(routes)
+
+    # Register the JSON API defined in uwlink/api.py
+    from uwlink.api import api
+    app.register_blueprint(api)
+
+    # Register the maintenance commands defined in uwlink/commands.py
+    from uwlink import commands
+    commands.init_app(app)
+
+    if asgi:
+        from uwlink.asgi import create_asgi_app
+        return create_asgi_app(app)
     return app
@@ -0,0 +1,205 @@
+import math
+import time
+from fnmatch import fnmatchcase
+from threading import BoundedSemaphore, Lock
+
+from cachetools import LRUCache
+from flask import g, jsonify, request, session
+
+# Admission control for the expensive endpoints
+#
+# Searching and logging in cost far more than showing the feed, so a few clients sending them in a loop could keep
+# every worker busy. Endpoints are grouped into classes (ADMISSION_CLASSES), and before a request to one of them is
+# handled:
+#
+#   - the client's token bucket for that class has to have a token left. Buckets hold up to `burst` tokens and refill
+#     at `rate` tokens per second, so short bursts are fine but a sustained flood is turned away with 429 Too Many
+#     Requests. Clients are logged in users (by id) or IP addresses
+#   - if the class has a `concurrency` limit, fewer than that many of its requests can be running in this worker, so
+#     slow requests of one class can't take up all of a threaded worker's threads. Otherwise the request is turned away
+#     with 503 Service Unavailable
+#
+# Both are checked before the route runs and answered without touching MongoDB, with a Retry-After header saying when
+# to try again. Endpoints in no class, like the feed, are never limited
+#
+# Buckets are kept in memory by default, which means per worker. Setting ADMISSION_BACKEND to a Redis URL shares them
+# between workers (and servers), see RedisBackend. Behind a reverse proxy such as the Heroku router, set
+# ADMISSION_TRUSTED_PROXIES to the number of proxies so that clients are told apart by X-Forwarded-For
+#
+# Rejections per class are counted at /metrics, see uwlink/instrumentation.py
+#
+# https://en.wikipedia.org/wiki/Token_bucket
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/429
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Retry-After
+DEFAULT_CONFIG = {
+    'ADMISSION_ENABLED': True,
+    'ADMISSION_BACKEND': 'memory://',
+    'ADMISSION_TRUSTED_PROXIES': 0,
+    'ADMISSION_CLASSES': {
+        # Password hashing, also capped by the hashing queue in uwlink/passwords.py
+        'auth': {'endpoints': ('api.login', 'api.signup', 'api.update'), 'methods': ('POST',),
+                 'rate': 0.2, 'burst': 10},
+        'search': {'endpoints': ('api.result',), 'rate': 1, 'burst': 20, 'concurrency': 4},
+        'write': {'endpoints': ('api.create', 'api.join', 'api.leave', 'api.delete'), 'methods': ('POST',),
+                  'rate': 2, 'burst': 30},
+        'api': {'endpoints': ('api_v1.*',), 'rate': 5, 'burst': 50, 'concurrency': 8}
+    }
+}
+
+# How many clients' buckets the memory backend keeps. A bucket that was evicted starts again full, which is what it
+# would have refilled to anyway unless the client is very active
+MEMORY_BACKEND_SIZE = 100000
+
+
+# Token buckets in a dict, shared by the threads of one worker
+class MemoryBackend:
+    def __init__(self):
+        self.buckets = LRUCache(maxsize=MEMORY_BACKEND_SIZE)
+        self.lock = Lock()
+
+    # Takes a token from the bucket. Returns 0 if there was one, or else how many seconds until there will be
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+
+# Token buckets in Redis, shared by every worker. Each bucket is a hash updated by a Lua script, which Redis runs
+# atomically, and expires once it would have refilled anyway. Uses the Redis server's clock, so workers on different
+# machines agree on the time
+#
+# https://redis.io/commands/eval
+class RedisBackend:
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=['uwlink:admission:' + key], args=[rate, burst]))
+
+
+def _backend_for(url):
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    raise ValueError('Unsupported ADMISSION_BACKEND: {}'.format(url))
+
+
+class AdmissionController:
+    def __init__(self, app):
+        self.classes = app.config['ADMISSION_CLASSES']
+        self.backend = _backend_for(app.config['ADMISSION_BACKEND'])
+        self.trusted_proxies = app.config['ADMISSION_TRUSTED_PROXIES']
+        self.slots = {name: BoundedSemaphore(spec['concurrency'])
+                      for name, spec in self.classes.items() if spec.get('concurrency')}
+        # Endpoint name -> class name (or None), filled in as endpoints are first requested
+        self.endpoint_classes = {}
+        self.lock = Lock()
+        self.rejected = {(name, status): 0 for name in self.classes for status in (429, 503)}
+
+    def class_for(self, endpoint):
+        if endpoint not in self.endpoint_classes:
+            self.endpoint_classes[endpoint] = next(
+                (name for name, spec in self.classes.items()
+                 if any(fnmatchcase(endpoint, pattern) for pattern in spec['endpoints'])), None)
+        return self.endpoint_classes[endpoint]
+
+    # The logged in user's id, straight from the session cookie (see Flask-Login) so that no user has to be loaded, or
+    # else the client's IP address
+    def client(self):
+        user_id = session.get('_user_id')
+        if user_id:
+            return 'user:' + user_id
+        forwarded = request.headers.get('X-Forwarded-For')
+        if self.trusted_proxies and forwarded:
+            addresses = [address.strip() for address in forwarded.split(',')]
+            return 'ip:' + addresses[max(len(addresses) - self.trusted_proxies, 0)]
+        return 'ip:' + (request.remote_addr or 'unknown')
+
+    def _reject(self, name, status, retry_after):
+        with self.lock:
+            self.rejected[(name, status)] += 1
+        message = 'Too many requests, please try again later.' if status == 429 else \
+            'The server is busy, please try again in a moment.'
+        headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+        if request.blueprint == 'api_v1' or request.accept_mimetypes.best == 'application/json':
+            return jsonify(error=message), status, headers
+        return message, status, headers
+
+    def admit(self):
+        if request.endpoint is None:
+            return None
+        name = self.class_for(request.endpoint)
+        if name is None:
+            return None
+        spec = self.classes[name]
+        if spec.get('methods') and request.method not in spec['methods']:
+            return None
+        wait = self.backend.take('{}:{}'.format(name, self.client()), spec['rate'], spec['burst'])
+        if wait > 0:
+            return self._reject(name, 429, wait)
+        slots = self.slots.get(name)
+        if slots is not None:
+            if not slots.acquire(blocking=False):
+                return self._reject(name, 503, 1)
+            g.admission_slots = slots
+        return None
+
+    def release(self, exception=None):
+        slots = g.pop('admission_slots', None)
+        if slots is not None:
+            slots.release()
+
+    def to_prometheus(self):
+        with self.lock:
+            rejected = dict(self.rejected)
+        lines = ['# HELP uwlink_admission_rejected_total Requests turned away by admission control.',
+                 '# TYPE uwlink_admission_rejected_total counter']
+        for (name, status), count in sorted(rejected.items()):
+            lines.append('uwlink_admission_rejected_total{{class="{}",status="{}"}} {}'.format(name, status, count))
+        return '\n'.join(lines) + '\n'
+
+
+# Registered right after the instrumentation in create_app, so that requests are turned away before anything else runs
+# for them but are still counted
+def init_app(app):
+    from uwlink import instrumentation
+
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    if not app.config['ADMISSION_ENABLED']:
+        return
+    controller = AdmissionController(app)
+    app.extensions['admission'] = controller
+    app.before_request(controller.admit)
+    app.teardown_request(controller.release)
+    instrumentation.add_collector(app, controller.to_prometheus)
@@ -0,0 +1,104 @@
+import calendar
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from pymongo import UpdateOne
+from uwlink.models import Event, DayCount
+
+# The calendar of upcoming events
+#
+# The month view shows how many events there are on each day, from DayCount documents (one per day with events). Those
+# counts are changed with $inc whenever an event is created, imported or deleted, so showing a month reads at most 42
+# small documents by _id instead of counting the events themselves. `flask rebuild-day-counts` recomputes all of them
+# from the events, e.g. if they ever drift
+#
+# The events themselves are only loaded for the day that is selected in the month view (CALENDAR_EVENTS_PER_PAGE at a
+# time), or for the days of the week view (the first CALENDAR_EVENTS_PER_DAY of each). Both are a single range query
+# on the index on Event.time that only returns a few events per day, so however many events a day has, a page only
+# loads and renders a few of them
+#
+# https://docs.mongodb.com/manual/reference/operator/update/inc/
+# https://docs.python.org/3/library/calendar.html#calendar.Calendar.monthdatescalendar
+CALENDAR_EVENTS_PER_PAGE = 20
+CALENDAR_EVENTS_PER_DAY = 5
+
+# The Event fields shown in the calendar
+CALENDAR_EVENT_FIELDS = ('name', 'time', 'creator', 'participant_count', 'participant_sample')
+
+# Weeks start on Sunday, like the calendar in most people's phones
+FIRST_WEEKDAY = calendar.SUNDAY
+
+
+def day_of(time):
+    return datetime.combine(time.date(), datetime.min.time())
+
+
+# Adds the given {day: change} to the day counts
+def add_day_counts(days):
+    if days:
+        DayCount._get_collection().bulk_write([UpdateOne({'_id': day}, {'$inc': {'event_count': change}}, upsert=True)
+                                               for day, change in days.items()], ordered=False)
+
+
+# Adds change (1 or -1) to the count of the day of each of the given event times
+def count_events(times, change=1):
+    add_day_counts({day: change * count for day, count in Counter(day_of(time) for time in times if time).items()})
+
+
+# {date: number of events} for the dates from start up to (not including) end that have events
+def day_counts(start, end):
+    start = datetime.combine(start, datetime.min.time())
+    end = datetime.combine(end, datetime.min.time())
+    return {count['_id'].date(): count['event_count'] for count in DayCount._get_collection().find(
+        {'_id': {'$gte': start, '$lt': end}, 'event_count': {'$gt': 0}})}
+
+
+# The events on a day, earliest first
+def events_on(day, page=1, per_page=CALENDAR_EVENTS_PER_PAGE):
+    start = datetime.combine(day, datetime.min.time())
+    return list(Event.objects(time__gte=start, time__lt=start + timedelta(days=1)).only(*CALENDAR_EVENT_FIELDS)
+                .order_by('time', 'id').skip((page - 1) * per_page).limit(per_page))
+
+
+# {date: the first per_day events of that date, earliest first} for the 7 days starting on start, in one aggregation:
+# the week's events are found with a range query on the index on Event.time, grouped by day and cut to per_day each on
+# the server, so only the events shown are sent back however busy the week is
+#
+# https://docs.mongodb.com/manual/reference/operator/aggregation/slice/
+def week_events(start, per_day=CALENDAR_EVENTS_PER_DAY):
+    start = datetime.combine(start, datetime.min.time())
+    days = Event._get_collection().aggregate([
+        {'$match': {'time': {'$gte': start, '$lt': start + timedelta(days=7)}}},
+        {'$sort': {'time': 1, '_id': 1}},
+        {'$project': dict.fromkeys(CALENDAR_EVENT_FIELDS, 1)},
+        {'$group': {'_id': {'year': {'$year': '$time'}, 'month': {'$month': '$time'}, 'day': {'$dayOfMonth': '$time'}},
+                    'events': {'$push': '$$ROOT'}}},
+        {'$project': {'events': {'$slice': ['$events', per_day]}}}])
+    return {date(day['_id']['year'], day['_id']['month'], day['_id']['day']):
+            [Event._from_son(event) for event in day['events']] for day in days}
+
+
+# The weeks shown for a month, as lists of 7 dates, including the days of the previous and next months that fill the
+# first and last weeks
+def month_weeks(year, month):
+    return calendar.Calendar(FIRST_WEEKDAY).monthdatescalendar(year, month)
+
+
+# The first day of the week that day is in
+def week_start(day):
+    return day - timedelta(days=(day.weekday() - FIRST_WEEKDAY) % 7)
+
+
+# Recomputes every DayCount from the events. Returns the number of days with events
+def rebuild_day_counts():
+    counts = [{'_id': datetime(group['_id']['year'], group['_id']['month'], group['_id']['day']),
+               'event_count': group['event_count']}
+              for group in Event._get_collection().aggregate([
+                  {'$match': {'time': {'$type': 'date'}}},
+                  {'$group': {'_id': {'year': {'$year': '$time'}, 'month': {'$month': '$time'},
+                                      'day': {'$dayOfMonth': '$time'}},
+                              'event_count': {'$sum': 1}}}])]
+    DayCount.drop_collection()
+    if counts:
+        DayCount._get_collection().insert_many(counts)
+    return len(counts)
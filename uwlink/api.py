@@ -0,0 +1,110 @@
+import json
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import Blueprint, Response, abort, request, stream_with_context
+from uwlink.models import User, Event, Tag
+
+# Version 1 of the JSON API, built on the models' to_dict methods
+#
+# List endpoints stream newline-delimited JSON (one document per line) straight from a MongoDB cursor, so even a full
+# export of every event is sent in constant memory:
+#
+#   GET /api/v1/events?fields=event_id,name,time&limit=100&after=<event_id>
+#   GET /api/v1/users
+#   GET /api/v1/tags
+#
+# fields selects which to_dict keys are returned (and only those fields are loaded from MongoDB). Documents are returned
+# in id order; to get the next page, pass the id of the last document as after. Without limit, every document is
+# returned
+#
+#   GET /api/v1/events/<event_id>
+#
+# returns a single event as regular JSON
+#
+# https://github.com/ndjson/ndjson-spec
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+DEFAULT_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 5000
+
+# The to_dict keys of each model and the document fields they come from. The API needs no login, so users' email
+# addresses are left out
+API_FIELDS = {
+    Event: {'event_id': 'id', 'name': 'name', 'description': 'description', 'tags': 'tags', 'time': 'time',
+            'creator': 'creator', 'participant_count': 'participant_count',
+            'participant_sample': 'participant_sample', 'created_at': 'created_at'},
+    User: {'owner_id': 'id', 'username': 'username', 'events_created': 'events_created', 'joined_at': 'joined_at'},
+    Tag: {'tag_id': 'id', 'name': 'name', 'event_count': 'event_count', 'last_used': 'last_used'}
+}
+
+
+def json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def to_json(data):
+    return json.dumps(data, default=json_default)
+
+
+def _object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        abort(400, 'Invalid id: {}'.format(value))
+
+
+def _selected_fields(document_class):
+    fields = API_FIELDS[document_class]
+    selected = request.args.get('fields')
+    if not selected:
+        return list(fields)
+    selected = selected.split(',')
+    unknown = [key for key in selected if key not in fields]
+    if unknown:
+        abort(400, 'Unknown fields: {}'.format(', '.join(unknown)))
+    return selected
+
+
+def _stream(document_class):
+    keys = _selected_fields(document_class)
+    documents = document_class.objects.only(*[API_FIELDS[document_class][key] for key in keys]).order_by('id')
+    if request.args.get('after'):
+        documents = documents(id__gt=_object_id(request.args.get('after')))
+    limit = request.args.get('limit', type=int)
+    if limit:
+        documents = documents.limit(limit)
+    batch_size = min(max(request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int), 0), MAX_BATCH_SIZE)
+    # no_cache keeps MongoEngine from holding on to every document it has returned
+    #
+    # https://docs.mongoengine.org/apireference.html#mongoengine.queryset.QuerySet.no_cache
+    documents = documents.batch_size(batch_size).no_cache()
+
+    def generate():
+        for document in documents:
+            data = document.to_dict()
+            yield to_json({key: data[key] for key in keys}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.route('/events', methods=['GET'])
+def events():
+    return _stream(Event)
+
+
+@api.route('/events/<event_id>', methods=['GET'])
+def event(event_id):
+    keys = _selected_fields(Event)
+    data = Event.objects.get_or_404(id=_object_id(event_id)).to_dict()
+    return Response(to_json({key: data[key] for key in keys}), mimetype='application/json')
+
+
+@api.route('/users', methods=['GET'])
+def users():
+    return _stream(User)
+
+
+@api.route('/tags', methods=['GET'])
+def tags():
+    return _stream(Tag)
@@ -0,0 +1,159 @@
+import asyncio
+
+from bson.objectid import ObjectId
+from werkzeug.urls import url_decode
+from uwlink.api import API_FIELDS, to_json
+from uwlink.loaders import PROFILE_EVENT_FIELDS
+from uwlink.models import User, Event, Membership
+from uwlink.pagination import keyset_query, to_keyset_page
+from uwlink.search import SearchQuery
+
+# Async serving mode
+#
+# With gunicorn's sync workers, every request holds a whole worker process while it waits for MongoDB. In async mode
+# the app is served by an ASGI server instead, e.g.
+#
+#   uvicorn asgi:app --workers 4
+#
+# and the read-heavy pages are also available as JSON from handlers that query MongoDB with Motor, the asyncio MongoDB
+# driver. While one request waits for the database the same process serves others, and requests that need several
+# queries send them concurrently:
+#
+#   GET /async/feed?before=<cursor>            a page of the feed
+#   GET /async/result?name=...&tags=...        a page of search results, with the same parameters as /result
+#   GET /async/profile/<username>?page=N       a user and one page of their created and joined events
+#
+# Every other path goes to the regular Flask app, which runs in a thread pool. The server's lifespan messages are
+# answered here: the Motor client is created on startup and closed on shutdown. bench/asgi_check.py checks this mode
+# against a local mongod
+#
+# asgiref, motor and uvicorn are only needed for this mode, and are only imported when it is used
+#
+# https://asgi.readthedocs.io/en/latest/
+# https://motor.readthedocs.io/en/stable/tutorial-asyncio.html
+# https://asgiref.readthedocs.io/en/latest/
+
+
+class AsyncApp:
+    def __init__(self, flask_app, feed_per_page=8, result_per_page=8, profile_per_page=4):
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.feed_per_page = feed_per_page
+        self.result_per_page = result_per_page
+        self.profile_per_page = profile_per_page
+        self.db = None
+
+    # Motor clients belong to the event loop they were created on, so the client is created on the first request
+    def _database(self):
+        if self.db is None:
+            from motor.motor_asyncio import AsyncIOMotorClient
+
+            client = AsyncIOMotorClient(self.flask_app.config['MONGODB_HOST'])
+            self.db = client.get_default_database()
+        return self.db
+
+    def _collection(self, document_class):
+        return self._database()[document_class._get_collection_name()]
+
+    # Startup and shutdown of the server process. WsgiToAsgi only handles HTTP, so these can't be passed on to Flask
+    #
+    # https://asgi.readthedocs.io/en/latest/specs/lifespan.html
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._database()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.db is not None:
+                    self.db.client.close()
+                    self.db = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        path = scope.get('path', '')
+        if scope['type'] != 'http' or not path.startswith('/async/'):
+            return await self.wsgi(scope, receive, send)
+        args = url_decode(scope.get('query_string', b''))
+        if path == '/async/feed':
+            status, body = await self.feed(args)
+        elif path == '/async/result':
+            status, body = await self.result(args)
+        elif path.startswith('/async/profile/'):
+            status, body = await self.profile(path[len('/async/profile/'):], args)
+        else:
+            status, body = 404, {'error': 'not found'}
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': to_json(body).encode()})
+
+    async def _find(self, document_class, query, sort=None, skip=0, limit=0, projection=None):
+        cursor = self._collection(document_class).find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        documents = await cursor.skip(skip).limit(limit).to_list(length=None)
+        return [document_class._from_son(document) for document in documents]
+
+    async def feed(self, args):
+        query, sort, reversed_order = keyset_query(args.get('before'), args.get('after'))
+        items = await self._find(Event, query, sort, limit=self.feed_per_page + 1)
+        page = to_keyset_page(items, self.feed_per_page, bool(query), reversed_order)
+        return 200, {'events': [event.to_dict() for event in page.items],
+                     'newer': page.prev_cursor,
+                     'older': page.next_cursor}
+
+    # The count and the page are queried at the same time. The events have every field of the JSON API, which leaves out
+    # search_terms
+    async def result(self, args):
+        query = SearchQuery.from_args(args).to_mongo()
+        page = max(args.get('page', 1, type=int), 1)
+        count, events = await asyncio.gather(
+            self._collection(Event).count_documents(query),
+            self._find(Event, query, [('time', 1), ('_id', 1)], skip=(page - 1) * self.result_per_page,
+                       limit=self.result_per_page, projection={'search_terms': 0}))
+        return 200, {'count': count,
+                     'page': page,
+                     'events': [event.to_dict() for event in events]}
+
+    async def _event_page(self, event_ids, page):
+        newest_first = event_ids[::-1]
+        start = (page - 1) * self.profile_per_page
+        page_ids = newest_first[start:start + self.profile_per_page]
+        return await self._load_events(page_ids)
+
+    async def _load_events(self, page_ids):
+        events = await self._find(Event, {'_id': {'$in': [ObjectId(event_id) for event_id in page_ids]}},
+                                  projection=dict.fromkeys(PROFILE_EVENT_FIELDS, 1))
+        events = {str(event.id): event for event in events}
+        return [events[event_id].to_dict() for event_id in page_ids if event_id in events]
+
+    async def _joined_page(self, user_id, page):
+        memberships = await self._collection(Membership).find({'user_id': user_id}, {'event_id': 1}) \
+            .sort('joined_at', -1).skip((page - 1) * self.profile_per_page).limit(self.profile_per_page) \
+            .to_list(length=None)
+        return await self._load_events([str(membership['event_id']) for membership in memberships])
+
+    # Both lists of events are queried at the same time, once the user is found. The user has the same fields as in the
+    # JSON API, so no email address
+    async def profile(self, username, args):
+        user = await self._collection(User).find_one({'username': username}, {'hashed_password': 0})
+        if user is None:
+            return 404, {'error': 'not found'}
+        user = User._from_son(user)
+        page = max(args.get('page', 1, type=int), 1)
+        events_created, events_joined = await asyncio.gather(self._event_page(user.events_created, page),
+                                                             self._joined_page(user.id, page))
+        data = user.to_dict()
+        return 200, {'user': {key: data[key] for key in API_FIELDS[User]},
+                     'page': page,
+                     'events_created': events_created,
+                     'events_joined': events_joined}
+
+
+def create_asgi_app(flask_app):
+    return AsyncApp(flask_app)
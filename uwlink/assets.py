@@ -0,0 +1,226 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+from markupsafe import Markup
+
+# Static asset pipeline
+#
+# `flask assets build` (see uwlink/commands.py) copies everything in uwlink/static to uwlink/static/dist under a name
+# containing a hash of its contents, e.g. feed.css -> feed.3b5e1f0c9a2d.css, and writes a manifest of the new names.
+# While the manifest exists, url_for('static', filename='feed.css') in templates returns /assets/feed.3b5e1f0c9a2d.css,
+# which is served with a far-future Cache-Control: a changed file gets a new name, so browsers can keep every asset
+# forever and never have to ask whether it changed
+#
+# The build also
+# - saves every CSS and JS file gzip- and brotli-compressed, and /assets/ serves the smallest version the browser
+#   accepts without compressing anything per request
+# - shrinks images to at most MAX_IMAGE_WIDTH pixels wide, and saves smaller and WebP versions of them, which
+#   background_image() picks from with media queries and image-set()
+#
+# Pillow (for images) and Brotli are only needed to build; without them images are copied as they are and only gzip
+# versions are saved
+#
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Caching#cache_busting
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Content-Encoding
+# https://developer.mozilla.org/en-US/docs/Web/CSS/image/image-set
+DIST_FOLDER = 'dist'
+MANIFEST = 'manifest.json'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+COMPRESSED_EXTENSIONS = ('.css', '.js')
+IMAGE_WIDTHS = (640, 1280)
+MAX_IMAGE_WIDTH = 1920
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+
+# One year, the longest max-age browsers honour
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Precompressed versions, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _hashed_name(filename, content):
+    name, extension = os.path.splitext(filename)
+    return '{}.{}{}'.format(name, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def _write(folder, filename, content):
+    hashed = _hashed_name(filename, content)
+    with open(os.path.join(folder, hashed), 'wb') as file:
+        file.write(content)
+    return hashed
+
+
+def _compress(path, content):
+    with open(path + '.gz', 'wb') as file:
+        file.write(gzip.compress(content, 9))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + '.br', 'wb') as file:
+        file.write(brotli.compress(content))
+
+
+def _encode_image(image, extension):
+    from io import BytesIO
+
+    output = BytesIO()
+    if extension == '.webp':
+        image.save(output, 'WEBP', quality=WEBP_QUALITY, method=6)
+    elif extension == '.png':
+        image.save(output, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def _resized(image, width):
+    from PIL import Image
+
+    if image.width <= width:
+        return image
+    return image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+
+
+# Returns the hashed name of the full size image and a list of its variants, smallest first
+def _build_image(source, dist, filename):
+    from PIL import Image
+
+    name, extension = os.path.splitext(filename)
+    image = Image.open(source)
+    image.load()
+    variants = []
+    for width in IMAGE_WIDTHS + (MAX_IMAGE_WIDTH,):
+        if width != MAX_IMAGE_WIDTH and width >= image.width:
+            continue
+        resized = _resized(image, width)
+        variants.append({
+            'width': resized.width,
+            'image': _write(dist, '{}-{}{}'.format(name, resized.width, extension), _encode_image(resized, extension)),
+            'webp': _write(dist, '{}-{}.webp'.format(name, resized.width), _encode_image(resized, '.webp'))
+        })
+    return variants[-1]['image'], variants
+
+
+# CSS files refer to other static files by relative URLs, which have to be changed to the hashed names
+def _rewrite_urls(css, files):
+    def replace(match):
+        url = match.group(2)
+        return 'url({0}{1}{0})'.format(match.group(1), files.get(url, url))
+
+    return re.sub(r'''url\((['"]?)([^'")]+)\1\)''', replace, css)
+
+
+# Builds uwlink/static/dist and returns the manifest. Images are built first, so that CSS can refer to them
+def build(static_folder, progress=None):
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+    try:
+        import PIL  # noqa: F401
+        images = True
+    except ImportError:
+        images = False
+    filenames = sorted(filename for filename in os.listdir(static_folder)
+                       if os.path.isfile(os.path.join(static_folder, filename)) and not filename.startswith('.'))
+    filenames.sort(key=lambda filename: filename.endswith(COMPRESSED_EXTENSIONS))
+    manifest = {'files': {}, 'images': {}}
+    for filename in filenames:
+        source = os.path.join(static_folder, filename)
+        extension = os.path.splitext(filename)[1].lower()
+        if images and extension in IMAGE_EXTENSIONS:
+            hashed, variants = _build_image(source, dist, filename)
+            manifest['images'][filename] = variants
+        else:
+            with open(source, 'rb') as file:
+                content = file.read()
+            if extension == '.css':
+                content = _rewrite_urls(content.decode(), manifest['files']).encode()
+            hashed = _write(dist, filename, content)
+            if extension in COMPRESSED_EXTENSIONS:
+                _compress(os.path.join(dist, hashed), content)
+        manifest['files'][filename] = hashed
+        if progress:
+            progress(filename, hashed)
+    with open(os.path.join(dist, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+# The manifest of the last build, or None if there is none
+def load_manifest(app):
+    if 'assets_manifest' not in app.extensions:
+        try:
+            with open(os.path.join(app.static_folder, DIST_FOLDER, MANIFEST)) as file:
+                app.extensions['assets_manifest'] = json.load(file)
+        except FileNotFoundError:
+            app.extensions['assets_manifest'] = None
+    return app.extensions['assets_manifest']
+
+
+# Used as url_for in templates: static files are looked up in the manifest
+def asset_url_for(endpoint, **values):
+    if endpoint == 'static':
+        manifest = load_manifest(current_app)
+        if manifest and values.get('filename') in manifest['files']:
+            values['filename'] = manifest['files'][values['filename']]
+            return url_for('assets', **values)
+    return url_for(endpoint, **values)
+
+
+def _image_set(variant):
+    return "image-set(url('{}') type('image/webp'), url('{}') type('{}'))".format(
+        url_for('assets', filename=variant['webp']), url_for('assets', filename=variant['image']),
+        'image/png' if variant['image'].endswith('.png') else 'image/jpeg')
+
+
+# CSS rules setting the background image of selector. With a build, smaller screens get smaller images and browsers that
+# support WebP get WebP; browsers that don't understand image-set() keep the plain url()
+def background_image(filename, selector='body'):
+    manifest = load_manifest(current_app)
+    variants = manifest['images'].get(filename) if manifest else None
+    if not variants:
+        return Markup("{} {{ background-image: url('{}'); }}".format(selector,
+                                                                    asset_url_for('static', filename=filename)))
+    rules = []
+    for index, variant in enumerate(reversed(variants)):
+        rule = "{} {{ background-image: url('{}'); background-image: {}; }}".format(
+            selector, url_for('assets', filename=variant['image']), _image_set(variant))
+        if index > 0:
+            rule = '@media (max-width: {}px) {{ {} }}'.format(variant['width'], rule)
+        rules.append(rule)
+    return Markup('\n'.join(rules))
+
+
+# Serves the files of the build, precompressed if possible. Their names change whenever their contents do, so they can
+# be cached forever
+def assets(filename):
+    folder = os.path.join(current_app.static_folder, DIST_FOLDER)
+    response = None
+    if filename.endswith(COMPRESSED_EXTENSIONS):
+        for encoding, extension in ENCODINGS:
+            if encoding in request.accept_encodings and os.path.isfile(os.path.join(folder, filename + extension)):
+                response = send_from_directory(folder, filename + extension,
+                                               mimetype='text/css' if filename.endswith('.css') else 'text/javascript')
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = send_from_directory(folder, filename)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = send_from_directory(folder, filename)
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(CACHE_MAX_AGE)
+    return response
+
+
+def init_app(app):
+    app.add_url_rule('/assets/<path:filename>', 'assets', assets)
+    app.jinja_env.globals['url_for'] = asset_url_for
+    app.add_template_global(background_image)
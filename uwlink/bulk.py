@@ -0,0 +1,264 @@
+import collections
+import csv
+import json
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from werkzeug.security import generate_password_hash
+from uwlink import agenda, document_cache, search_index
+from uwlink.api import to_json
+from uwlink.models import User, Event, Membership, Tag, Counter
+from uwlink.participation import PARTICIPANT_SAMPLE_SIZE
+from uwlink.sequences import CREATED_AT_COUNTER, next_created_at
+
+# Bulk import and export of events, users and tags, used by the `flask data` commands in uwlink/commands.py
+#
+# Imports write documents with insert_many in batches, and compute everything that create() would otherwise maintain
+# one event at a time (search terms, tag and day counts, participant counts and samples, the users' events_created) in
+# memory, writing it with a few bulk writes per batch and at the end
+#
+# Records are read from JSON lines files (one JSON object per line) or CSV files with a header row. In CSV files, list
+# fields (tags, participants) are separated by spaces, like the tags field of the event form. Dates are ISO 8601
+#
+# Exports are backups in the same format, which the imports restore (see EXPORT_FIELDS)
+#
+# https://docs.mongodb.com/manual/reference/method/db.collection.insertMany/
+# https://docs.mongodb.com/manual/reference/method/db.collection.bulkWrite/
+LIST_FIELDS = ('tags', 'participants', 'events_created')
+
+
+def read_records(file, file_format):
+    if file_format == 'csv':
+        for row in csv.DictReader(file):
+            yield {key: value.split() if key in LIST_FIELDS else value for key, value in row.items() if value != ''}
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def _list(value):
+    if value is None:
+        return []
+    return value.split() if isinstance(value, str) else list(value)
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Reports the number of records done and the throughput so far to progress(count, rate)
+class Progress:
+    def __init__(self, progress):
+        self.progress = progress
+        self.count = 0
+        self.started = time.monotonic()
+
+    def add(self, count):
+        self.count += count
+        if self.progress:
+            self.progress(self.count, self.count / max(time.monotonic() - self.started, 1e-9))
+
+
+def _insert_many(collection, documents):
+    try:
+        return len(collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        return e.details['nInserted']
+
+
+def _bulk_write(collection, requests, batch_size):
+    for batch in _batches(requests, batch_size):
+        collection.bulk_write(batch, ordered=False)
+
+
+# Looks up the ids of the usernames that aren't in user_ids yet, adding them to it
+def _resolve_usernames(usernames, user_ids):
+    missing = [username for username in usernames if username not in user_ids]
+    if missing:
+        user_ids.update((user['username'], user['_id'])
+                        for user in User._get_collection().find({'username': {'$in': missing}}, {'username': 1}))
+
+
+# Imports events. The creators and participants should already exist (import users first): events are added to their
+# creators' events_created, and a Membership is created for each participant (unknown usernames are skipped). Events
+# without created_at get increasing values starting now, like events created in the app. Events with an event_id keep
+# it, and are skipped if an event with that id already exists, so that restoring an export twice changes nothing the
+# second time. Returns the number of events inserted
+def import_events(records, batch_size=1000, progress=None):
+    events = Event._get_collection()
+    tag_counts = collections.Counter()
+    tag_last_used = {}
+    created = collections.defaultdict(list)
+    days = collections.Counter()
+    user_ids = {}
+    next_time = next_created_at()
+    last_created_at = next_time
+    inserted = 0
+    report = Progress(progress)
+    for batch in _batches(records, batch_size):
+        documents = []
+        memberships = []
+        _resolve_usernames({username for record in batch for username in _list(record.get('participants'))}, user_ids)
+        kept_ids = [ObjectId(record['event_id']) for record in batch if record.get('event_id')]
+        existing = set(events.find({'_id': {'$in': kept_ids}}).distinct('_id')) if kept_ids else set()
+        for record in batch:
+            event_id = ObjectId(record['event_id']) if record.get('event_id') else ObjectId()
+            if event_id in existing:
+                continue
+            created_at = _datetime(record.get('created_at'))
+            if created_at is None:
+                created_at = next_time
+                next_time += timedelta(milliseconds=1)
+            last_created_at = max(last_created_at, created_at)
+            tags = list(dict.fromkeys(_list(record.get('tags'))))
+            event_time = _datetime(record.get('time'))
+            participants = [username for username in dict.fromkeys(_list(record.get('participants')))
+                            if username in user_ids and username != record.get('creator')]
+            documents.append({
+                '_id': event_id,
+                'name': record.get('name'),
+                'description': record.get('description'),
+                'tags': tags,
+                'time': event_time,
+                'creator': record.get('creator'),
+                'participant_count': len(participants),
+                'participant_sample': participants[:PARTICIPANT_SAMPLE_SIZE],
+                'created_at': created_at,
+                'version': 0,
+                'search_terms': search_index.terms_for(record.get('name'))
+            })
+            tag_counts.update(tags)
+            if event_time:
+                days[agenda.day_of(event_time)] += 1
+            for tag in tags:
+                tag_last_used[tag] = max(tag_last_used.get(tag, created_at), created_at)
+            created[record.get('creator')].append(str(event_id))
+            memberships.extend({'event_id': event_id, 'user_id': user_ids[username], 'joined_at': created_at}
+                               for username in participants)
+        if documents:
+            inserted += _insert_many(events, documents)
+        if memberships:
+            _insert_many(Membership._get_collection(), memberships)
+        report.add(len(documents))
+
+    # Keep the created_at counter ahead of everything imported, see uwlink/sequences.py
+    Counter._get_collection().update_one({'_id': CREATED_AT_COUNTER}, {'$max': {'value': last_created_at}},
+                                         upsert=True)
+    _bulk_write(Tag._get_collection(),
+                [UpdateOne({'name': tag}, {'$inc': {'event_count': count}, '$max': {'last_used': tag_last_used[tag]}},
+                           upsert=True)
+                 for tag, count in tag_counts.items()], batch_size)
+    users = User._get_collection()
+    _bulk_write(users, [UpdateOne({'username': username}, {'$push': {'events_created': {'$each': event_ids}}})
+                        for username, event_ids in created.items() if username], batch_size)
+    agenda.add_day_counts(days)
+    # The creators changed, see uwlink/document_cache.py
+    _resolve_usernames([username for username in created if username], user_ids)
+    document_cache.invalidate(User, *[user_ids[username] for username in created if username in user_ids])
+    return inserted
+
+
+# Imports users. Records need a hashed_password, or a password which is hashed with the configured method (slow, see
+# uwlink/passwords.py). Users with an owner_id keep it. Users whose id, username or email is already taken are skipped.
+# events_created is ignored: import_events adds the events to their creators. Returns the number of users inserted
+def import_users(records, batch_size=1000, progress=None):
+    users = User._get_collection()
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    inserted = 0
+    report = Progress(progress)
+    for batch in _batches(records, batch_size):
+        documents = []
+        for record in batch:
+            hashed_password = record.get('hashed_password')
+            if hashed_password is None and record.get('password') is not None:
+                hashed_password = generate_password_hash(record['password'], method)
+            document = {
+                'username': record.get('username'),
+                'email': record.get('email'),
+                'events_created': [],
+                'joined_at': _datetime(record.get('joined_at')) or datetime.now(),
+                'hashed_password': hashed_password
+            }
+            if record.get('owner_id'):
+                document['_id'] = ObjectId(record['owner_id'])
+            documents.append(document)
+        inserted += _insert_many(users, documents)
+        report.add(len(documents))
+    return inserted
+
+
+# The fields written by export, in order. Exports are backups that import_users and import_events restore, so unlike the
+# JSON API they include the users' email addresses and password hashes (keep export files private) and the usernames of
+# each event's participants, in the order they joined. What import_events computes (participant counts and samples,
+# the users' events_created, tag and day counts) is left out
+EXPORT_FIELDS = {
+    Event: ('event_id', 'name', 'description', 'tags', 'time', 'creator', 'participants', 'created_at'),
+    User: ('owner_id', 'username', 'email', 'hashed_password', 'joined_at'),
+    Tag: ('tag_id', 'name', 'event_count', 'last_used')
+}
+
+
+# {event id: usernames of the participants, in the order they joined} for the given events, in two queries
+def _participants(event_ids):
+    memberships = list(Membership._get_collection()
+                       .find({'event_id': {'$in': event_ids}}, {'event_id': 1, 'user_id': 1}).sort('joined_at', 1))
+    usernames = {user['_id']: user['username'] for user in User._get_collection().find(
+        {'_id': {'$in': list({membership['user_id'] for membership in memberships})}}, {'username': 1})}
+    participants = collections.defaultdict(list)
+    for membership in memberships:
+        if membership['user_id'] in usernames:
+            participants[membership['event_id']].append(usernames[membership['user_id']])
+    return participants
+
+
+# The to_dict of each document, plus the fields that only exports have
+def _export_batch(document_class, documents):
+    records = [document.to_dict() for document in documents]
+    if document_class is User:
+        for record, document in zip(records, documents):
+            record['hashed_password'] = document.hashed_password
+    elif document_class is Event:
+        participants = _participants([document.id for document in documents])
+        for record, document in zip(records, documents):
+            record['participants'] = participants.get(document.id, [])
+    return records
+
+
+# Writes every document of a model to file, as JSON lines or CSV, with the fields in EXPORT_FIELDS. Returns the number
+# of documents written
+def export(document_class, file, file_format, batch_size=1000, progress=None):
+    keys = EXPORT_FIELDS[document_class]
+    documents = document_class.objects.order_by('id').batch_size(batch_size).no_cache()
+    writer = None
+    if file_format == 'csv':
+        writer = csv.DictWriter(file, fieldnames=keys)
+        writer.writeheader()
+    report = Progress(progress)
+    for batch in _batches(documents, batch_size):
+        for data in _export_batch(document_class, batch):
+            if writer:
+                writer.writerow({key: ' '.join(data[key]) if isinstance(data[key], list) else
+                                 data[key].isoformat() if isinstance(data[key], datetime) else data[key]
+                                 for key in keys})
+            else:
+                file.write(to_json({key: data[key] for key in keys}) + '\n')
+        report.add(len(batch))
+    return report.count
@@ -0,0 +1,55 @@
+from bson.objectid import ObjectId
+from uwlink import document_cache, jobs
+from uwlink.models import Event, Membership
+
+# Updates that fan out to many documents when an event is deleted or a user is renamed
+#
+# Each fan-out is a single update_many per collection instead of a load and save per document. Fan-outs touching more
+# than CASCADE_INLINE_LIMIT documents run as background jobs (see uwlink/jobs.py), so the request returns right away
+#
+# https://docs.mongodb.com/manual/reference/method/db.collection.updateMany/
+# https://docs.mongodb.com/manual/reference/operator/update/positional/
+CASCADE_INLINE_LIMIT = 200
+
+
+def _run(kind, size, owner, fn, *args):
+    if size > CASCADE_INLINE_LIMIT:
+        return jobs.submit(kind, size, owner, fn, *args)
+    fn(*args)
+    return None
+
+
+def _remove_event_references(event_id):
+    Membership._get_collection().delete_many({'event_id': event_id})
+
+
+# Removes a deleted event's Membership documents. Returns the background Job, owned by the user who deleted the event,
+# or None if the work was done inline
+def remove_event_references(event_id, participant_count, owner):
+    if not participant_count:
+        return None
+    return _run('remove_event_references', participant_count, owner, _remove_event_references, ObjectId(event_id))
+
+
+# Memberships refer to users by id, so only the usernames copied into events need changing: the creator, and the
+# participant samples the user is in. A username appears at most once in a sample, so the positional $ operator (which
+# updates the first matching array element) replaces it. The changed events are dropped from the document cache
+def _rename_user_references(old_username, new_username, user_id, events_created):
+    events = Event._get_collection()
+    if events_created:
+        events.update_many({'_id': {'$in': [ObjectId(event_id) for event_id in events_created]}},
+                           {'$set': {'creator': new_username}, '$inc': {'version': 1}})
+        document_cache.invalidate(Event, *events_created)
+    events_joined = [membership['event_id'] for membership in
+                     Membership._get_collection().find({'user_id': user_id}, {'event_id': 1})]
+    if events_joined:
+        events.update_many({'_id': {'$in': events_joined}, 'participant_sample': old_username},
+                           {'$set': {'participant_sample.$': new_username}, '$inc': {'version': 1}})
+        document_cache.invalidate(Event, *events_joined)
+
+
+# Replaces a user's old username with the new one in the events they created and joined. Returns the background Job,
+# or None if the work was done inline
+def rename_user_references(old_username, new_username, user_id, events_created):
+    return _run('rename_user_references', len(events_created) + Membership.objects(user_id=user_id).count(),
+                user_id, _rename_user_references, old_username, new_username, user_id, list(events_created))
@@ -0,0 +1,210 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import UpdateOne
+from uwlink import agenda, assets, bulk, config, document_cache, recommendations, search_index
+from uwlink.models import User, Event, Membership, Tag
+from uwlink.participation import PARTICIPANT_SAMPLE_SIZE
+
+# Maintenance commands, run with the flask command line tool, e.g.
+#
+#   FLASK_APP=run.py flask reindex-search
+#
+# https://flask.palletsprojects.com/en/1.1.x/cli/#custom-commands
+
+
+# Fills in Event.search_terms for every event. Needed once for events created before the search index existed, and
+# whenever uwlink/search_index.py changes how names are split up
+@click.command('reindex-search')
+@click.option('--batch-size', default=1000, help='Number of events updated per bulk write.')
+@with_appcontext
+def reindex_search(batch_size):
+    collection = Event._get_collection()
+    requests = []
+    count = 0
+    for event in collection.find({}, {'name': 1}):
+        requests.append(UpdateOne({'_id': event['_id']},
+                                  {'$set': {'search_terms': search_index.terms_for(event.get('name'))}}))
+        if len(requests) >= batch_size:
+            collection.bulk_write(requests, ordered=False)
+            count += len(requests)
+            requests = []
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+        count += len(requests)
+    document_cache.clear()
+    click.echo('Reindexed {} events'.format(count))
+
+
+# Rebuilds the tags collection from Event.tags. Tags used to store the ids of all of their events, and are now only
+# counts (see uwlink/tags.py); this converts existing data, and can be rerun at any time to fix the counts
+@click.command('migrate-tags')
+@with_appcontext
+def migrate_tags():
+    tags = [{'name': tag['_id'], 'event_count': tag['event_count'], 'last_used': tag['last_used']}
+            for tag in Event._get_collection().aggregate([
+                {'$unwind': '$tags'},
+                {'$group': {'_id': '$tags', 'event_count': {'$sum': 1}, 'last_used': {'$max': '$created_at'}}}])]
+    Tag.drop_collection()
+    if tags:
+        Tag._get_collection().insert_many(tags)
+    click.echo('Migrated {} tags'.format(len(tags)))
+
+
+# Recomputes the per-day event counts shown by the calendar, see uwlink/agenda.py. Needed once for events created
+# before the counts existed
+@click.command('rebuild-day-counts')
+@with_appcontext
+def rebuild_day_counts():
+    click.echo('Counted events on {} days'.format(agenda.rebuild_day_counts()))
+
+
+# Moves Event.participants (a list of usernames) into Membership documents, see uwlink/participation.py, and removes
+# User.events_joined. The time each user joined wasn't stored, so the event's created_at is used. Safe to rerun:
+# existing memberships are kept
+@click.command('migrate-participation')
+@click.option('--batch-size', default=1000, help='Number of events migrated per batch.')
+@with_appcontext
+def migrate_participation(batch_size):
+    events = Event._get_collection()
+    user_ids = {}
+    count = 0
+    memberships = 0
+    found = events.find({'participants': {'$exists': True}}, {'participants': 1, 'created_at': 1}) \
+        .batch_size(batch_size)
+    for batch in bulk._batches(found, batch_size):
+        bulk._resolve_usernames({username for event in batch for username in event.get('participants') or []},
+                                user_ids)
+        documents = []
+        requests = []
+        for event in batch:
+            participants = [username for username in dict.fromkeys(event.get('participants') or [])
+                            if username in user_ids]
+            documents.extend({'event_id': event['_id'], 'user_id': user_ids[username],
+                              'joined_at': event.get('created_at')}
+                             for username in participants)
+            requests.append(UpdateOne({'_id': event['_id']},
+                                      {'$set': {'participant_count': len(participants),
+                                                'participant_sample': participants[:PARTICIPANT_SAMPLE_SIZE]},
+                                       '$unset': {'participants': ''}}))
+        if documents:
+            memberships += bulk._insert_many(Membership._get_collection(), documents)
+        events.bulk_write(requests, ordered=False)
+        count += len(requests)
+    User._get_collection().update_many({'events_joined': {'$exists': True}}, {'$unset': {'events_joined': ''}})
+    document_cache.clear()
+    click.echo('Migrated {} events, {} memberships'.format(count, memberships))
+
+
+# Creates the indexes and compiles the templates, see uwlink/config.py. Run it as a release step before new code starts
+# serving, so that no request has to wait for an index build
+@click.command('preload')
+@with_appcontext
+def preload():
+    config.preload(current_app)
+    click.echo('Preloaded')
+
+
+# Bulk import and export, see uwlink/bulk.py. For example:
+#
+#   flask data import-users users.jsonl
+#   flask data import-events events.csv --format csv --batch-size 5000
+#   flask data export events events.jsonl
+#
+# Exports are backups: restore one by importing the users first, then the events. User exports contain password hashes
+@click.group('data')
+def data():
+    pass
+
+
+def _report(count, rate):
+    click.echo('{} records ({:.0f}/s)'.format(count, rate), err=True)
+
+
+FORMAT_OPTION = click.option('--format', 'file_format', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+BATCH_SIZE_OPTION = click.option('--batch-size', default=1000, help='Number of documents written per batch.')
+
+
+@data.command('import-events')
+@click.argument('file', type=click.File('r'))
+@FORMAT_OPTION
+@BATCH_SIZE_OPTION
+@with_appcontext
+def import_events(file, file_format, batch_size):
+    count = bulk.import_events(bulk.read_records(file, file_format), batch_size, _report)
+    click.echo('Imported {} events'.format(count))
+
+
+@data.command('import-users')
+@click.argument('file', type=click.File('r'))
+@FORMAT_OPTION
+@BATCH_SIZE_OPTION
+@with_appcontext
+def import_users(file, file_format, batch_size):
+    count = bulk.import_users(bulk.read_records(file, file_format), batch_size, _report)
+    click.echo('Imported {} users'.format(count))
+
+
+@data.command('export')
+@click.argument('collection', type=click.Choice(['events', 'users', 'tags']))
+@click.argument('file', type=click.File('w'))
+@FORMAT_OPTION
+@BATCH_SIZE_OPTION
+@with_appcontext
+def export(collection, file, file_format, batch_size):
+    document_class = {'events': Event, 'users': User, 'tags': Tag}[collection]
+    count = bulk.export(document_class, file, file_format, batch_size, _report)
+    click.echo('Exported {} {}'.format(count, collection), err=True)
+
+
+# Static asset builds, see uwlink/assets.py. On Heroku, bin/post_compile runs `flask assets build` while the slug is
+# compiled. Locally, run it again after changing anything in uwlink/static
+@click.group('assets')
+def assets_group():
+    pass
+
+
+@assets_group.command('build')
+@with_appcontext
+def build_assets():
+    manifest = assets.build(current_app.static_folder,
+                            lambda filename, hashed: click.echo('{} -> {}'.format(filename, hashed)))
+    click.echo('Built {} files'.format(len(manifest['files'])))
+
+
+# Event recommendations, see uwlink/recommendations.py. Run `flask recommendations build` once, then `flask
+# recommendations refresh` periodically (e.g. every few minutes) and `build` again daily, as events start and end
+@click.group('recommendations')
+def recommendations_group():
+    pass
+
+
+def _report_users(done, total):
+    click.echo('{}/{} users'.format(done, total), err=True)
+
+
+@recommendations_group.command('build')
+@click.option('--batch-size', type=int, help='Number of users scored at a time.')
+@with_appcontext
+def build_recommendations(batch_size):
+    count = recommendations.build(batch_size=batch_size, progress=_report_users)
+    click.echo('Built recommendations for {} users'.format(count))
+
+
+@recommendations_group.command('refresh')
+@click.option('--batch-size', type=int, help='Number of users scored at a time.')
+@with_appcontext
+def refresh_recommendations(batch_size):
+    count = recommendations.refresh(batch_size=batch_size, progress=_report_users)
+    click.echo('Refreshed recommendations for {} users'.format(count))
+
+
+def init_app(app):
+    app.cli.add_command(reindex_search)
+    app.cli.add_command(migrate_tags)
+    app.cli.add_command(migrate_participation)
+    app.cli.add_command(rebuild_day_counts)
+    app.cli.add_command(preload)
+    app.cli.add_command(data)
+    app.cli.add_command(assets_group)
+    app.cli.add_command(recommendations_group)
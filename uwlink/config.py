@@ -0,0 +1,165 @@
+import logging
+import os
+import tempfile
+
+import mongoengine
+from flask_mongoengine.connection import create_connections
+from jinja2 import FileSystemBytecodeCache
+from pymongo import ReadPreference
+from pymongo.errors import PyMongoError
+
+# Configuration profiles
+#
+# The UWLINK_CONFIG environment variable picks one of the PROFILES below (development by default). Any setting that
+# appears in a profile can then be overridden with an environment variable of the same name, e.g.
+# MONGODB_MAX_POOL_SIZE=50, and finally by the config passed to create_app
+#
+# The MONGODB_* pool and timeout settings are passed to the pymongo client. Pool sizes are per process, so with
+# gunicorn the cluster sees up to workers x MONGODB_MAX_POOL_SIZE connections. MONGODB_MIN_POOL_SIZE keeps a few
+# connections open so that requests don't wait for a new connection (a TLS handshake with Atlas) after a quiet spell,
+# and MONGODB_WAIT_QUEUE_TIMEOUT_MS makes a request fail quickly instead of queueing forever when the pool is used up
+#
+# https://pymongo.readthedocs.io/en/stable/api/pymongo/mongo_client.html
+# https://docs.mongodb.com/manual/core/read-preference/
+# https://jinja.palletsprojects.com/en/3.0.x/api/#bytecode-cache
+PROFILES = {
+    'development': {
+        'DEBUG': True,
+        'TEMPLATES_AUTO_RELOAD': True,
+        'JINJA_BYTECODE_CACHE_DIR': None,
+        'INSTRUMENTATION_METRICS_ENDPOINT': True
+    },
+    'production': {
+        'DEBUG': False,
+        'TEMPLATES_AUTO_RELOAD': False,
+        'JINJA_BYTECODE_CACHE_DIR': os.path.join(tempfile.gettempdir(), 'uwlink-jinja'),
+        # /metrics is off. To scrape it, set INSTRUMENTATION_METRICS_ENDPOINT=1 and INSTRUMENTATION_METRICS_TOKEN=<secret>,
+        # see uwlink/instrumentation.py
+        'INSTRUMENTATION_METRICS_ENDPOINT': False,
+        'INSTRUMENTATION_METRICS_TOKEN': '',
+        'MONGODB_MAX_POOL_SIZE': 20,
+        'MONGODB_MIN_POOL_SIZE': 2,
+        'MONGODB_MAX_IDLE_TIME_MS': 300000,
+        'MONGODB_CONNECT_TIMEOUT_MS': 5000,
+        'MONGODB_SERVER_SELECTION_TIMEOUT_MS': 5000,
+        'MONGODB_SOCKET_TIMEOUT_MS': 15000,
+        'MONGODB_WAIT_QUEUE_TIMEOUT_MS': 2000,
+        # Reads go to the primary, or to a secondary while there is no primary (e.g. during a failover)
+        'MONGODB_READ_PREFERENCE': 'PRIMARY_PREFERRED'
+    },
+    'testing': {
+        'DEBUG': False,
+        'TESTING': True,
+        'MONGODB_HOST': 'mongomock://localhost/uwlink-test',
+        'WTF_CSRF_ENABLED': False,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1',
+        'ADMISSION_ENABLED': False
+    }
+}
+
+# Setting -> pymongo client option
+CLIENT_OPTIONS = {
+    'MONGODB_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGODB_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGODB_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGODB_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGODB_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'MONGODB_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGODB_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS'
+}
+
+
+# Environment variables are strings, so they are converted to the type of the profile's value
+def _from_environment(key, default):
+    value = os.environ[key]
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+# Flask MongoEngine only passes a few MONGODB_* settings on to the client, the rest have to go in MONGODB_SETTINGS. The
+# client only connects when it is first used (connect=False), which is what makes creating the app before gunicorn
+# forks safe
+#
+# http://docs.mongoengine.org/projects/flask-mongoengine/en/latest/#configuration
+def _mongodb_settings(config):
+    settings = {'host': config['MONGODB_HOST']}
+    if not config['MONGODB_HOST'].startswith('mongomock://'):
+        settings['connect'] = False
+        settings.update({option: config[key] for key, option in CLIENT_OPTIONS.items()
+                         if config.get(key) is not None})
+    if config.get('MONGODB_READ_PREFERENCE'):
+        settings['read_preference'] = getattr(ReadPreference, config['MONGODB_READ_PREFERENCE'].upper())
+    return settings
+
+
+def load(app, overrides=None):
+    profile = os.environ.get('UWLINK_CONFIG', 'development')
+    if profile not in PROFILES:
+        raise ValueError('Unknown UWLINK_CONFIG {}, expected one of {}'.format(profile, ', '.join(PROFILES)))
+    app.config['PROFILE'] = profile
+    app.config.update(PROFILES[profile])
+    known = {}
+    for settings in PROFILES.values():
+        known.update(settings)
+    for key, default in known.items():
+        if key in os.environ:
+            app.config[key] = _from_environment(key, default)
+    if overrides:
+        app.config.update(overrides)
+    if 'MONGODB_SETTINGS' not in app.config:
+        app.config['MONGODB_SETTINGS'] = _mongodb_settings(app.config)
+    app.debug = app.config['DEBUG']
+
+    if app.config.get('JINJA_BYTECODE_CACHE_DIR'):
+        os.makedirs(app.config['JINJA_BYTECODE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE_DIR'])
+
+
+def _document_classes():
+    from uwlink import models
+
+    return [value for value in vars(models).values()
+            if isinstance(value, type) and issubclass(value, mongoengine.Document)
+            and value is not mongoengine.Document and not value._meta.get('abstract')]
+
+
+# Gets a process ready to serve its first request as fast as the rest. Run by `flask preload` (e.g. in a release
+# step) and in the gunicorn master before it forks the workers (see gunicorn.conf.py), so that the workers start with:
+#
+#   - every index created (or checked to exist) instead of MongoEngine creating them on the first use of each model
+#   - every template compiled, and written to the bytecode cache for processes that don't share the master's memory
+#   - the static asset manifest loaded
+#
+# The database client used here is then replaced with a new one that hasn't connected yet, since pymongo clients can't
+# be shared with forked processes. Each worker connects its own, see warm_worker
+#
+# https://docs.gunicorn.org/en/stable/settings.html#preload-app
+# https://pymongo.readthedocs.io/en/stable/faq.html#is-pymongo-fork-safe
+def preload(app):
+    from uwlink import db
+    from uwlink.assets import load_manifest
+
+    with app.app_context():
+        for document_class in _document_classes():
+            document_class.ensure_indexes()
+        templates = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+        for template in templates:
+            app.jinja_env.get_template(template)
+        load_manifest(app)
+    # mongomock keeps its data in the client, so an in-memory database is kept as it is
+    if not app.config['MONGODB_HOST'].startswith('mongomock://'):
+        mongoengine.disconnect()
+        app.extensions['mongoengine'][db]['conn'] = create_connections(app.config)
+    logging.info('Preloaded %d models and %d templates', len(_document_classes()), len(templates))
+
+
+# Opens a worker's connection pool right after it is forked, before it accepts requests. If MongoDB can't be reached
+# the worker starts anyway, and connects on its first request like before
+def warm_worker():
+    try:
+        mongoengine.connection.get_connection().admin.command('ping')
+    except PyMongoError:
+        logging.exception('Could not connect to MongoDB while starting the worker')
@@ -0,0 +1,252 @@
+import logging
+import os
+from threading import Lock
+
+import bson
+from cachetools import TTLCache
+
+# A read cache for User and Event documents, shared between gunicorn workers
+#
+# The identity map (uwlink/identity_map.py) only lasts for one request, so every request used to load the logged in
+# user (and any event it looks up by id) from MongoDB again. Loads by id that miss the identity map now go through two
+# more tiers before MongoDB:
+#
+#   local   an LRU cache in each worker, whose entries expire after DOCUMENT_CACHE_LOCAL_TTL seconds
+#   shared  optional, set with DOCUMENT_CACHE_SHARED_URL (or the environment variable of the same name): a Redis
+#           server shared by every worker, e.g. redis://localhost:6379/0, or memory:// for a dict shared within one
+#           process, which stands in for Redis in tests and benchmarks
+#
+# Documents are stored as BSON, so every hit returns a new instance which can be changed without affecting the cache.
+# Fields listed in the model's uncached_fields, like User.hashed_password, are left out of the stored copy, so they
+# never reach Redis; code that needs them loads the document from MongoDB (by username, or with get_fresh)
+#
+# Writes invalidate the cached copy before the request returns: saving or deleting a cached document does it by itself
+# (see CachedDocument), and code that changes documents with atomic updates calls invalidate. Invalidation removes the
+# entry from this worker's local tier and from the shared tier, so other workers see the change once their own local
+# copy expires; keep DOCUMENT_CACHE_LOCAL_TTL short for that reason. Shared entries expire after
+# DOCUMENT_CACHE_SHARED_TTL seconds, which also bounds how long a copy read just before a concurrent write can survive
+#
+# Cached copies can therefore be a little old, which is fine for showing pages but not for writes. Code that changes a
+# document based on what it loaded, or checks a password against it, loads it with get_fresh (see
+# uwlink/identity_map.py), and lists that several requests can add to at once, like User.events_created, are changed
+# with atomic $push and $pull updates instead of saving the whole list
+#
+# Hit and miss counts for each tier are served at /metrics, see uwlink/instrumentation.py
+#
+# https://redis.io/commands/set
+# https://cachetools.readthedocs.io/en/stable/#cachetools.TTLCache
+DEFAULT_CONFIG = {
+    'DOCUMENT_CACHE_SIZE': 10000,
+    'DOCUMENT_CACHE_LOCAL_TTL': 5,
+    'DOCUMENT_CACHE_SHARED_URL': os.environ.get('DOCUMENT_CACHE_SHARED_URL'),
+    'DOCUMENT_CACHE_SHARED_TTL': 300
+}
+
+KEY_PREFIX = 'uwlink:document:'
+
+
+def _key(document_class, document_id):
+    return '{}{}:{}'.format(KEY_PREFIX, document_class._get_collection_name(), document_id)
+
+
+# The memory:// shared tier. Every MemoryStore shares the same dict, so apps created in the same process (e.g. one per
+# simulated worker in a test) see each other's writes
+class MemoryStore:
+    entries = {}
+    lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = value
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(KEY_PREFIX)]:
+                del self.entries[key]
+
+
+# The redis:// shared tier. The redis package is only needed when this is configured
+#
+# https://github.com/andymccurdy/redis-py
+class RedisStore:
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+    def delete(self, keys):
+        self.client.delete(*keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=KEY_PREFIX + '*', count=1000))
+        for start in range(0, len(keys), 1000):
+            self.client.delete(*keys[start:start + 1000])
+
+
+def _store_for(url):
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return MemoryStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    raise ValueError('Unsupported DOCUMENT_CACHE_SHARED_URL: {}'.format(url))
+
+
+class DocumentCache:
+    def __init__(self):
+        self.lock = Lock()
+        self.local = None
+        self.shared = None
+        self.shared_ttl = None
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def configure(self, size, local_ttl, shared, shared_ttl):
+        with self.lock:
+            self.local = TTLCache(maxsize=size, ttl=local_ttl) if size else None
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+
+    @property
+    def enabled(self):
+        return self.local is not None or self.shared is not None
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    # The shared tier is only a cache: if it can't be reached, requests carry on with MongoDB
+    def _shared(self, method, *args):
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception:
+            logging.exception('Shared document cache %s failed', method)
+            self._count('errors')
+            return None
+
+    # The cached document, or None
+    def get(self, document_class, document_id):
+        key = _key(document_class, document_id)
+        data = None
+        if self.local is not None:
+            with self.lock:
+                data = self.local.get(key)
+        if data is not None:
+            self._count('local_hits')
+        elif self.shared is not None:
+            data = self._shared('get', key)
+            if data is not None:
+                self._count('shared_hits')
+                if self.local is not None:
+                    with self.lock:
+                        self.local[key] = data
+        if data is None:
+            self._count('misses')
+            return None
+        return document_class._from_son(bson.decode(data))
+
+    def add(self, document):
+        key = _key(type(document), document.id)
+        son = document.to_mongo()
+        for field in document.uncached_fields:
+            son.pop(document._fields[field].db_field, None)
+        data = bson.encode(son)
+        if self.local is not None:
+            with self.lock:
+                self.local[key] = data
+        if self.shared is not None:
+            self._shared('set', key, data, self.shared_ttl)
+
+    def invalidate(self, document_class, *document_ids):
+        keys = [_key(document_class, document_id) for document_id in document_ids]
+        if not keys:
+            return
+        if self.local is not None:
+            with self.lock:
+                for key in keys:
+                    self.local.pop(key, None)
+        if self.shared is not None:
+            self._shared('delete', keys)
+        with self.lock:
+            self.stats['invalidations'] += len(keys)
+
+    # Drops everything, e.g. after a migration that changed documents in bulk
+    def clear(self):
+        if self.local is not None:
+            with self.lock:
+                self.local.clear()
+        if self.shared is not None:
+            self._shared('clear')
+
+    def to_prometheus(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lines = ['# HELP uwlink_document_cache_lookups_total Loads by id that reached the document cache.',
+                 '# TYPE uwlink_document_cache_lookups_total counter']
+        for result, key in (('local_hit', 'local_hits'), ('shared_hit', 'shared_hits'), ('miss', 'misses')):
+            lines.append('uwlink_document_cache_lookups_total{{result="{}"}} {}'.format(result, stats[key]))
+        lines += ['# HELP uwlink_document_cache_invalidations_total Cached documents dropped after writes.',
+                  '# TYPE uwlink_document_cache_invalidations_total counter',
+                  'uwlink_document_cache_invalidations_total {}'.format(stats['invalidations']),
+                  '# HELP uwlink_document_cache_errors_total Failed requests to the shared tier.',
+                  '# TYPE uwlink_document_cache_errors_total counter',
+                  'uwlink_document_cache_errors_total {}'.format(stats['errors'])]
+        return '\n'.join(lines) + '\n'
+
+
+# One per process. Jobs and commands invalidate through it too, outside of requests
+document_cache = DocumentCache()
+
+
+def invalidate(document_class, *document_ids):
+    document_cache.invalidate(document_class, *document_ids)
+
+
+def clear():
+    document_cache.clear()
+
+
+# Models that inherit from this (before db.Document) are cached, and drop their cached copy whenever they are saved or
+# deleted. uncached_fields are left out of the cached copy
+#
+# https://docs.mongoengine.org/apireference.html#mongoengine.Document.save
+class CachedDocument:
+    uncached_fields = ()
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        document_cache.invalidate(type(self), self.id)
+        return result
+
+    def delete(self, *args, **kwargs):
+        document_id = self.id
+        result = super().delete(*args, **kwargs)
+        document_cache.invalidate(type(self), document_id)
+        return result
+
+
+def init_app(app):
+    from uwlink import instrumentation
+
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    document_cache.configure(app.config['DOCUMENT_CACHE_SIZE'], app.config['DOCUMENT_CACHE_LOCAL_TTL'],
+                             _store_for(app.config['DOCUMENT_CACHE_SHARED_URL']),
+                             app.config['DOCUMENT_CACHE_SHARED_TTL'])
+    if document_cache.to_prometheus not in instrumentation.collectors:
+        instrumentation.collectors.append(document_cache.to_prometheus)
@@ -8,7 +8,7 @@ from wtforms.validators import DataRequired, Length, Regexp, EqualTo, Validation
 class EventForm(FlaskForm):
     name = StringField('Event Name', validators=[DataRequired()])
     description = TextAreaField('Event Description', validators=[DataRequired()])
-    tags = StringField('Tags (separate with spaces)')
+    tags = StringField('Tags (separate with spaces)', render_kw={'list': 'tag-suggestions', 'autocomplete': 'off'})
     date = DateField('Date (YYYY-MM-DD)', format='%Y-%m-%d')
     time = TimeField('Time (HH:MM)', format='%H:%M')
     submit = SubmitField('Post Event')
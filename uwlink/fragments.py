@@ -0,0 +1,70 @@
+import hashlib
+import json
+from threading import Lock
+
+from cachetools import LRUCache
+from flask import render_template
+from markupsafe import Markup
+from uwlink.assets import load_manifest
+
+# Caching for the feed
+#
+# Rendered event cards (templates/_event_card.html) are cached by event id and Event.version. Every change that shows up
+# on a card (joining, leaving, renaming the creator or a participant) increments the event's version, so a cached card
+# is never out of date: changed events simply get a new cache key, and the old card is evicted least recently used
+# first. The Join/Leave/Delete buttons depend on who is looking, so they are rendered around the cached card
+#
+# Anonymous feed pages also get a weak ETag made from the ids and versions of their events. Browsers and pollers send it
+# back in If-None-Match, and if the page hasn't changed they get an empty 304 response, which only needed one small
+# query for the ids and versions
+#
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+EVENT_CARD_CACHE_SIZE = 2048
+
+event_card_cache = LRUCache(maxsize=EVENT_CARD_CACHE_SIZE)
+event_card_cache_lock = Lock()
+
+# The fields rendered on an event card, plus the ones needed for paging
+EVENT_CARD_FIELDS = ('name', 'description', 'time', 'creator', 'participant_count', 'participant_sample', 'created_at',
+                     'version')
+
+# Changing these templates, or rebuilding the static assets they link to (see uwlink/assets.py), changes every page, so
+# they are part of every ETag
+FEED_TEMPLATES = ('base.html', 'feed.html', '_event_card.html', '_participants.html')
+
+
+# Available in templates as event_card(event)
+def event_card(event):
+    key = (str(event.id), event.version or 0)
+    with event_card_cache_lock:
+        html = event_card_cache.get(key)
+    if html is None:
+        html = Markup(render_template('_event_card.html', event=event))
+        with event_card_cache_lock:
+            event_card_cache[key] = html
+    return html
+
+
+def _templates_digest(app):
+    if 'feed_templates_digest' not in app.extensions:
+        digest = hashlib.sha1()
+        for template in FEED_TEMPLATES:
+            source, _, _ = app.jinja_loader.get_source(app.jinja_env, template)
+            digest.update(source.encode())
+        digest.update(json.dumps(load_manifest(app), sort_keys=True).encode())
+        app.extensions['feed_templates_digest'] = digest.hexdigest()
+    return app.extensions['feed_templates_digest']
+
+
+# The ETag of a feed page, from the ids and versions of its events and which page links it shows
+def feed_etag(app, pagination):
+    digest = hashlib.sha1(_templates_digest(app).encode())
+    for event in pagination.items:
+        digest.update('{}:{};'.format(event.id, event.version or 0).encode())
+    digest.update('{}:{}'.format(pagination.has_prev, pagination.has_next).encode())
+    return digest.hexdigest()
+
+
+def init_app(app):
+    app.add_template_global(event_card)
@@ -0,0 +1,111 @@
+from flask import g, has_request_context
+from flask_mongoengine import BaseQuerySet
+from uwlink.document_cache import CachedDocument, document_cache
+
+# A per-request identity map for documents loaded by id
+#
+# A single page view often loads the same user several times: once in user_loader, then again in the route and in the
+# forms' validators. While handling a request, Model.objects.get(id=...) returns the document already loaded for that
+# id instead of querying MongoDB again, so every call site gets deduplicated loads for free
+#
+# Documents are shared between the call sites of one request, which is what the routes expect: a document changed and
+# saved in one place is seen with those changes everywhere else. The map is dropped at the end of the request
+#
+# https://martinfowler.com/eaaCatalog/identityMap.html
+
+
+class IdentityMap:
+    def __init__(self):
+        self.documents = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, document_class, document_id):
+        document = self.documents.get((document_class, str(document_id)))
+        if document is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return document
+
+    def add(self, document):
+        self.documents[(type(document), str(document.id))] = document
+
+    # Used after a document is changed in the database without going through the loaded instance, e.g. by an atomic
+    # update, so that the next load sees the change
+    def discard(self, document_class, document_id):
+        self.documents.pop((document_class, str(document_id)), None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# The identity map for the current request, or None outside of requests (e.g. in flask commands)
+def current_identity_map():
+    if not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+
+# Drops a document from the current request's identity map, if there is one
+def discard(document_class, document_id):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        identity_map.discard(document_class, document_id)
+
+
+# Drops a document that was changed with an atomic update from the current request's identity map and from the document
+# cache, so that the next load sees the change
+def forget(document_class, document_id):
+    discard(document_class, document_id)
+    document_cache.invalidate(document_class, document_id)
+
+
+# The queryset class for documents that go through the identity map. Only plain lookups by id are served from the map,
+# anything with other filters or a subset of fields goes to MongoDB as usual. Documents that aren't in the map yet are
+# looked up in the document cache shared between requests (see uwlink/document_cache.py) before MongoDB, if their class
+# is cached. This extends the Flask MongoEngine
+# queryset, which provides paginate and get_or_404
+#
+# https://docs.mongoengine.org/guide/querying.html#custom-querysets
+class IdentityMapQuerySet(BaseQuerySet):
+    def get(self, *q_objs, **query):
+        identity_map = current_identity_map()
+        if identity_map is None or q_objs or len(query) != 1 or self._query or self._loaded_fields:
+            return super().get(*q_objs, **query)
+        field, document_id = next(iter(query.items()))
+        if field not in ('id', 'pk'):
+            return super().get(*q_objs, **query)
+        document = identity_map.get(self._document, document_id)
+        if document is not None:
+            return document
+        cached = issubclass(self._document, CachedDocument) and document_cache.enabled
+        if cached:
+            document = document_cache.get(self._document, document_id)
+        if document is None:
+            document = super().get(*q_objs, **query)
+            if cached:
+                document_cache.add(document)
+        identity_map.add(document)
+        return document
+
+    # Loads a document by id from MongoDB, skipping the document cache, whose copy can be a few seconds old. For code
+    # that changes a document based on what it loaded, or checks something like a password against it. The fresh copy
+    # replaces the one in the identity map
+    def get_fresh(self, document_id):
+        document = super().get(id=document_id)
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.add(document)
+        return document
+
+
+# Adds an X-Identity-Map header with the request's hit and miss counts in debug mode
+def init_app(app):
+    @app.after_request
+    def add_identity_map_header(response):
+        if app.debug and 'identity_map' in g:
+            response.headers['X-Identity-Map'] = 'hits={hits}; misses={misses}'.format(**g.identity_map.stats())
+        return response
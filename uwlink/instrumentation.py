@@ -0,0 +1,209 @@
+import hmac
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+
+from flask import Response, abort, current_app, g, has_app_context, request
+from jinja2 import Template
+from pymongo import monitoring
+
+# Per-request instrumentation
+#
+# Every command the app sends to MongoDB goes through a pymongo command listener, which counts it and adds up how long
+# it took for the request that sent it. Template rendering is timed too. Each request also keeps a count of the "shapes"
+# of its queries (the command, the collection and the filter with the values left out): the same shape sent many
+# times in one request is usually a query inside a loop that should have been a single $in query (an N+1 query), so
+# requests that send any shape more than INSTRUMENTATION_REPEATED_QUERY_LIMIT times are logged
+#
+# In debug mode every response has the numbers for its request in headers:
+#
+#   X-Query-Count: 3
+#   X-Repeated-Queries: find event {"_id": "?"} x12
+#   Server-Timing: db;dur=4.1, render;dur=12.5, total;dur=19.8
+#
+# and the totals for each endpoint are served at /metrics in the Prometheus text format. They show how the app is used
+# and what it queries, so /metrics is off unless INSTRUMENTATION_METRICS_ENDPOINT is set (the development profile in
+# uwlink/config.py sets it). With INSTRUMENTATION_METRICS_TOKEN also set, /metrics only answers requests with the header
+# Authorization: Bearer <token>, which is how a Prometheus scrape job can be given access in production
+#
+# https://pymongo.readthedocs.io/en/stable/api/pymongo/monitoring.html
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+DEFAULT_CONFIG = {
+    'INSTRUMENTATION_REPEATED_QUERY_LIMIT': 5,
+    'INSTRUMENTATION_METRICS_ENDPOINT': False,
+    'INSTRUMENTATION_METRICS_TOKEN': None
+}
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.shapes = Counter()
+
+    def repeated(self, limit):
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > limit]
+
+
+def current_metrics():
+    if has_app_context():
+        return g.get('request_metrics')
+    return None
+
+
+# The filter of a command, for the commands the app sends
+def _filter(command_name, command):
+    if command_name in ('update', 'delete'):
+        statements = command.get(command_name + 's') or [{}]
+        return statements[0].get('q')
+    if command_name == 'aggregate':
+        stages = command.get('pipeline') or [{}]
+        return stages[0].get('$match')
+    return command.get('filter', command.get('query'))
+
+
+# Replaces the values in a query with ?, keeping the field names and operators
+def _shape(value):
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return [_shape(item) for item in value]
+    return '?'
+
+
+def query_shape(command_name, command):
+    return '{} {} {}'.format(command_name, command.get(command_name),
+                             json.dumps(_shape(_filter(command_name, command)), sort_keys=True))
+
+
+class QueryListener(monitoring.CommandListener):
+    def started(self, event):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.queries += 1
+            metrics.shapes[query_shape(event.command_name, event.command)] += 1
+
+    def succeeded(self, event):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.db_time += event.duration_micros / 1e6
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+# Times rendering. Templates rendered while rendering another one (like the event cards in the feed) are part of the
+# outer template's time
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        metrics = current_metrics()
+        if metrics is None:
+            return super().render(*args, **kwargs)
+        started = time.perf_counter()
+        metrics.render_depth += 1
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            metrics.render_depth -= 1
+            if metrics.render_depth == 0:
+                metrics.render_time += time.perf_counter() - started
+
+
+# Totals per endpoint since the process started
+class EndpointMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.endpoints = defaultdict(lambda: defaultdict(float))
+
+    def add(self, endpoint, metrics, repeated):
+        with self.lock:
+            totals = self.endpoints[endpoint]
+            totals['requests'] += 1
+            totals['queries'] += metrics.queries
+            totals['db_seconds'] += metrics.db_time
+            totals['render_seconds'] += metrics.render_time
+            totals['request_seconds'] += time.perf_counter() - metrics.started
+            totals['repeated_query_requests'] += 1 if repeated else 0
+
+    def to_prometheus(self):
+        metrics = (('uwlink_requests_total', 'counter', 'requests', 'Requests handled.'),
+                   ('uwlink_mongo_commands_total', 'counter', 'queries', 'Commands sent to MongoDB.'),
+                   ('uwlink_mongo_seconds_total', 'counter', 'db_seconds', 'Time spent waiting for MongoDB.'),
+                   ('uwlink_render_seconds_total', 'counter', 'render_seconds', 'Time spent rendering templates.'),
+                   ('uwlink_request_seconds_total', 'counter', 'request_seconds', 'Time spent handling requests.'),
+                   ('uwlink_repeated_query_requests_total', 'counter', 'repeated_query_requests',
+                    'Requests that sent the same query shape more than the repeated query limit.'))
+        with self.lock:
+            endpoints = {endpoint: dict(totals) for endpoint, totals in self.endpoints.items()}
+        lines = []
+        for name, metric_type, key, description in metrics:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for endpoint, totals in sorted(endpoints.items()):
+                lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, totals[key]))
+        return '\n'.join(lines) + '\n'
+
+
+endpoint_metrics = EndpointMetrics()
+
+# Other functions returning metrics in the Prometheus text format to serve at /metrics. Those of the whole process, like
+# the document cache's, are in collectors, and those of a single app, like its admission controller's, are added with
+# add_collector, so that apps created earlier in the same process (e.g. by tests) don't show up in later apps' metrics
+collectors = []
+
+
+def add_collector(app, collector):
+    app.extensions.setdefault('metrics_collectors', []).append(collector)
+
+
+# pymongo listeners are global, and only apply to clients created after they are registered
+listener = QueryListener()
+monitoring.register(listener)
+
+
+def metrics():
+    token = current_app.config['INSTRUMENTATION_METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        abort(404)
+    app_collectors = current_app.extensions.get('metrics_collectors', [])
+    body = endpoint_metrics.to_prometheus() + ''.join(collector() for collector in collectors + app_collectors)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+# Must be called before the MongoDB client is created, see create_app
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = RequestMetrics()
+
+    @app.after_request
+    def record_request_metrics(response):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return response
+        repeated = metrics.repeated(app.config['INSTRUMENTATION_REPEATED_QUERY_LIMIT'])
+        endpoint = request.endpoint or 'none'
+        endpoint_metrics.add(endpoint, metrics, repeated)
+        for shape, count in repeated:
+            logging.warning('Possible N+1 query in %s: %s sent %d times', endpoint, shape, count)
+        if app.debug:
+            response.headers['X-Query-Count'] = str(metrics.queries)
+            response.headers['Server-Timing'] = 'db;dur={:.1f}, render;dur={:.1f}, total;dur={:.1f}'.format(
+                metrics.db_time * 1000, metrics.render_time * 1000, (time.perf_counter() - metrics.started) * 1000)
+            if repeated:
+                response.headers['X-Repeated-Queries'] = ', '.join(
+                    '{} x{}'.format(shape, count) for shape, count in repeated)
+        return response
+
+    if app.config['INSTRUMENTATION_METRICS_ENDPOINT']:
+        app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,41 @@
+import logging
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from uwlink.models import Job
+
+# Background jobs for work that is too big to do while the user waits for a response
+#
+# Jobs run on a small thread pool inside the gunicorn worker that started them. Their progress is kept in a Job
+# document, so any worker can report it to the user who started the job (see the /job/<job_id> route). The thread pool
+# only starts its threads when the first job is submitted, i.e. after gunicorn has forked its workers
+#
+# Jobs are not retried. If the worker dies (it is restarted after a timeout, or the dyno is cycled), its jobs stay
+# 'running' forever; Job.worker records which process ran each job, so that jobs left behind by a process that no
+# longer exists can be found and rerun. The cascades are safe to run again
+#
+# https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+JOB_WORKERS = 2
+
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='uwlink-job')
+
+
+def _run(job, fn, args):
+    job.update(set__status='running', set__worker='{}:{}'.format(socket.gethostname(), os.getpid()))
+    try:
+        fn(*args)
+    except Exception as e:
+        logging.exception('Job %s (%s) failed', job.id, job.kind)
+        job.update(set__status='failed', set__error=str(e), set__finished_at=datetime.now())
+    else:
+        job.update(set__status='done', set__finished_at=datetime.now())
+
+
+# Runs fn(*args) in the background and returns its Job, which only its owner (a user id) can see
+def submit(kind, size, owner, fn, *args):
+    job = Job(kind=kind, owner=str(owner), status='queued', size=size, created_at=datetime.now())
+    job.save()
+    executor.submit(_run, job, fn, args)
+    return job
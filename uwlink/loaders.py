@@ -0,0 +1,41 @@
+from uwlink.models import Event, Membership
+
+# Helpers for loading the events a user created (User.events_created) or joined (their Membership documents)
+#
+# events_created holds event ids in the order the events were created. The profile pages only show one page of each
+# list, so only that page of ids is looked up, with a single $in query per list
+
+# The Event fields rendered by profile.html. Leaving the rest out (e.g. search_terms) keeps the documents small
+#
+# https://docs.mongoengine.org/guide/querying.html#retrieving-a-subset-of-fields
+PROFILE_EVENT_FIELDS = ('name', 'description', 'time', 'creator', 'participant_count', 'participant_sample')
+
+
+# Loads the events with the given ids in one query, in the same order as the ids. Ids of events that no longer exist
+# are skipped
+def load_events(event_ids, fields=PROFILE_EVENT_FIELDS):
+    events = {str(event.id): event for event in Event.objects(id__in=event_ids).only(*fields)}
+    return [events[event_id] for event_id in event_ids if event_id in events]
+
+
+def count_pages(event_ids, per_page):
+    return (len(event_ids) + per_page - 1) // per_page
+
+
+# Returns the events on the given page of a list of event ids, most recently added first
+def load_event_page(event_ids, page, per_page, fields=PROFILE_EVENT_FIELDS):
+    newest_first = event_ids[::-1]
+    start = (page - 1) * per_page
+    return load_events(newest_first[start:start + per_page], fields)
+
+
+def count_joined_pages(user_id, per_page):
+    return (Membership.objects(user_id=user_id).count() + per_page - 1) // per_page
+
+
+# Returns the events on the given page of the events a user joined, most recently joined first. Uses the index on
+# (user_id, -joined_at)
+def load_joined_page(user_id, page, per_page, fields=PROFILE_EVENT_FIELDS):
+    memberships = Membership._get_collection().find({'user_id': user_id}, {'event_id': 1}) \
+        .sort('joined_at', -1).skip((page - 1) * per_page).limit(per_page)
+    return load_events([str(membership['event_id']) for membership in memberships], fields)
@@ -1,4 +1,6 @@
 from uwlink import db
+from uwlink.document_cache import CachedDocument
+from uwlink.identity_map import IdentityMapQuerySet
 
 # The model classes here (anything which inherits from db.Document) represent data stored in the database
 #
@@ -10,39 +12,71 @@ from uwlink import db
 # https://github.com/UWFlow/rmc/blob/00bcc1450ffbec3a6c8d956a2a5d1bb3a04bfcb9/models/course.py
 
 
-class User(db.Document):
+# Users and events are also cached between requests, see uwlink/document_cache.py
+class User(CachedDocument, db.Document):
     # Setting unique=True causes MongoEngine to create this collection with a unique index on this field
     #
     # https://docs.mongodb.com/manual/core/index-unique/
     username = db.StringField(unique=True)
     email = db.StringField(unique=True)
-    events_joined = db.ListField(db.StringField())
     events_created = db.ListField(db.StringField())
     joined_at = db.DateTimeField()
 
-    # No need to include this in to_dict
+    # No need to include this in to_dict. It is kept out of the document cache too, logins and password changes load the
+    # user from MongoDB
     hashed_password = db.StringField()
+    uncached_fields = ('hashed_password',)
+
+    # Loads by id are deduplicated within a request, see uwlink/identity_map.py
+    #
+    # Users stored before participation moved to Membership documents still have events_joined until
+    # `flask migrate-participation` has run. Without strict, loading them ignores it instead of raising FieldDoesNotExist
+    meta = {
+        'queryset_class': IdentityMapQuerySet,
+        'strict': False
+    }
 
     def to_dict(self):
         return {
             "owner_id": str(self.id),
             "username": self.username,
             "email": self.email,
-            "events_joined": self.events_joined,
             "events_created": self.events_created,
             "joined_at": self.joined_at
         }
 
 
-class Event(db.Document):
+class Event(CachedDocument, db.Document):
     name = db.StringField()
     description = db.StringField()
     tags = db.ListField(db.StringField())
     time = db.DateTimeField()
     creator = db.StringField()
-    participants = db.ListField(db.StringField())
     created_at = db.DateTimeField()
 
+    # The participants themselves are Membership documents. Events only keep their number and the usernames of the first
+    # few, which is all an event card shows, so events stay small however many people join. See uwlink/participation.py
+    participant_count = db.IntField(default=0)
+    participant_sample = db.ListField(db.StringField())
+
+    # Incremented whenever something shown on the event's card changes, see uwlink/fragments.py
+    version = db.IntField(default=0)
+
+    # Substrings of the words in name, see uwlink/search_index.py. No need to include this in to_dict
+    search_terms = db.ListField(db.StringField())
+
+    # MongoEngine creates these indexes when the collection is first used. An index on a list field is a multikey index,
+    # with one entry per list element
+    #
+    # https://docs.mongoengine.org/guide/defining-documents.html#indexes
+    #
+    # Like User, events aren't strict so that the participants lists of events that haven't been migrated yet are ignored
+    meta = {
+        'indexes': ['search_terms', 'time', 'tags', ('-created_at', '-id')],
+        'queryset_class': IdentityMapQuerySet,
+        'strict': False
+    }
+
     def to_dict(self):
         return {
             "event_id": str(self.id),
@@ -51,18 +85,128 @@ class Event(db.Document):
             "tags": self.tags,
             "time": self.time,
             "creator": self.creator,
-            "participants": self.participants,
+            "participant_count": self.participant_count,
+            "participant_sample": self.participant_sample,
             "created_at": self.created_at
         }
 
 
+# A user taking part in an event, see uwlink/participation.py. The unique index makes joining twice impossible, and
+# finds the participants of an event (oldest first) and the events a user joined (newest first)
+#
+# https://docs.mongodb.com/manual/core/index-compound/
+class Membership(db.Document):
+    event_id = db.ObjectIdField(required=True)
+    user_id = db.ObjectIdField(required=True)
+    joined_at = db.DateTimeField()
+
+    meta = {
+        'indexes': [
+            {'fields': ('event_id', 'user_id'), 'unique': True},
+            ('event_id', 'joined_at'),
+            ('user_id', '-joined_at')
+        ]
+    }
+
+    def to_dict(self):
+        return {
+            "membership_id": str(self.id),
+            "event_id": str(self.event_id),
+            "user_id": str(self.user_id),
+            "joined_at": self.joined_at
+        }
+
+
+# Tags are metadata about the values found in Event.tags: how many events use each tag and when one was last created.
+# Finding the events with a tag is done with the multikey index on Event.tags, see uwlink/tags.py
 class Tag(db.Document):
-    name = db.StringField()
-    events = db.ListField(db.StringField())
+    name = db.StringField(unique=True)
+    event_count = db.IntField(default=0)
+    last_used = db.DateTimeField()
+
+    # Tags stored before this change still have the list of their events until `flask migrate-tags` has run. Without
+    # strict, loading them ignores it instead of raising FieldDoesNotExist
+    #
+    # https://docs.mongoengine.org/apireference.html#mongoengine.Document
+    meta = {
+        'strict': False
+    }
 
     def to_dict(self):
         return {
         "tag_id": str(self.id),
         "name": self.name,
-        "events": self.events
+        "event_count": self.event_count,
+        "last_used": self.last_used
+        }
+
+
+# The number of events on one day (the day's midnight), kept up to date with $inc as events are created and deleted,
+# see uwlink/agenda.py
+class DayCount(db.Document):
+    day = db.DateTimeField(primary_key=True)
+    event_count = db.IntField(default=0)
+
+    def to_dict(self):
+        return {
+            "day": self.day,
+            "event_count": self.event_count
+        }
+
+
+# A named value that is updated atomically on the server, see uwlink/sequences.py
+class Counter(db.Document):
+    name = db.StringField(primary_key=True)
+    value = db.DynamicField()
+
+    def to_dict(self):
+        return {
+        "name": self.name,
+        "value": self.value
+        }
+
+
+# A background job, see uwlink/jobs.py. status is one of 'queued', 'running', 'done' or 'failed', owner is the id of
+# the user whose request started it, and worker the process running it (host:pid). No need to include worker in to_dict
+class Job(db.Document):
+    kind = db.StringField()
+    owner = db.StringField()
+    worker = db.StringField()
+    status = db.StringField()
+    size = db.IntField()
+    error = db.StringField()
+    created_at = db.DateTimeField()
+    finished_at = db.DateTimeField()
+
+    def to_dict(self):
+        return {
+            "job_id": str(self.id),
+            "kind": self.kind,
+            "status": self.status,
+            "size": self.size,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+
+# Precomputed event recommendations for one user, see uwlink/recommendations.py. stale is set when the user's
+# participation changes, so that the next refresh recomputes them
+class Recommendation(db.Document):
+    user_id = db.StringField(primary_key=True)
+    event_ids = db.ListField(db.StringField())
+    computed_at = db.DateTimeField()
+    changed_at = db.DateTimeField()
+    stale = db.BooleanField(default=False)
+
+    meta = {
+        'indexes': ['stale']
+    }
+
+    def to_dict(self):
+        return {
+            "user_id": self.user_id,
+            "event_ids": self.event_ids,
+            "computed_at": self.computed_at,
+            "stale": self.stale
         }
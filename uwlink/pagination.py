@@ -0,0 +1,87 @@
+from datetime import datetime
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+# Keyset (cursor) pagination for lists ordered newest first by (created_at, id)
+#
+# Instead of skipping over the events on earlier pages, each page link carries a cursor: the created_at and id of the
+# last (or first) event shown. The next page is then the events just before that one, which the index on
+# (created_at, id) finds directly, so every page costs the same no matter how deep it is. No total count is needed
+#
+# https://use-the-index-luke.com/no-offset
+
+
+def encode_cursor(document):
+    return '{},{}'.format(document.created_at.isoformat(), document.id)
+
+
+# Returns (created_at, id), or None if the cursor is malformed
+def decode_cursor(cursor):
+    try:
+        created_at, document_id = cursor.split(',')
+        return datetime.fromisoformat(created_at), ObjectId(document_id)
+    except (ValueError, InvalidId):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, items, has_prev, has_next):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+
+    # Link to the newer events
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_prev and self.items else None
+
+    # Link to the older events
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_next and self.items else None
+
+
+def _before(created_at, document_id):
+    return {'$or': [{'created_at': {'$lt': created_at}},
+                    {'created_at': created_at, '_id': {'$lt': document_id}}]}
+
+
+def _after(created_at, document_id):
+    return {'$or': [{'created_at': {'$gt': created_at}},
+                    {'created_at': created_at, '_id': {'$gt': document_id}}]}
+
+
+# The raw query and sort order for a keyset page, and whether the results come back oldest first (for `after`) and need
+# to be reversed. Shared with code that queries MongoDB without MongoEngine, see uwlink/asgi.py
+def keyset_query(before=None, after=None):
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+    if after:
+        return _after(*after), [('created_at', 1), ('_id', 1)], True
+    if before:
+        return _before(*before), [('created_at', -1), ('_id', -1)], False
+    return {}, [('created_at', -1), ('_id', -1)], False
+
+
+# Turns the (up to per_page + 1) documents returned for keyset_query into a page
+def to_keyset_page(items, per_page, cursor_given, reversed_order):
+    if reversed_order:
+        return KeysetPage(items[:per_page][::-1], len(items) > per_page, True)
+    return KeysetPage(items[:per_page], cursor_given, len(items) > per_page)
+
+
+# Returns the page of documents just older than the `before` cursor, just newer than the `after` cursor, or the newest
+# page if neither is given. One extra document is loaded to find out whether there is a next page
+def keyset_page(queryset, per_page, before=None, after=None):
+    query, sort, reversed_order = keyset_query(before, after)
+    order = ['{}{}'.format('' if direction > 0 else '-', 'id' if field == '_id' else field) for field, direction in sort]
+    items = list(queryset(__raw__=query).order_by(*order).limit(per_page + 1))
+    return to_keyset_page(items, per_page, bool(query), reversed_order)
+
+
+# Old ?page=N links still work: the page is found with skip/limit once, and its links are cursors from then on
+def numbered_page(queryset, per_page, page):
+    page = max(page, 1)
+    items = list(queryset.order_by('-created_at', '-id').skip((page - 1) * per_page).limit(per_page + 1))
+    return KeysetPage(items[:per_page], page > 1, len(items) > per_page)
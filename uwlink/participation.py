@@ -0,0 +1,111 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from uwlink import document_cache, identity_map
+from uwlink.recommendations import mark_stale
+from uwlink.models import User, Event, Membership
+
+# Joining and leaving events
+#
+# Each participant is a Membership document, so an event's participants can be counted and paged through with the
+# compound indexes on Membership instead of being stored in the event. The event only keeps participant_count and
+# participant_sample (the usernames of the first PARTICIPANT_SAMPLE_SIZE participants), both changed with atomic updates
+# on the server: $inc, and $push with $slice to keep the sample short. The unique index on (event_id, user_id) means a
+# second join of the same event fails instead of counting the user twice, so submitting the same form twice changes
+# nothing the second time
+#
+# https://docs.mongodb.com/manual/reference/operator/update/inc/
+# https://docs.mongodb.com/manual/reference/operator/update/slice/
+PARTICIPANT_SAMPLE_SIZE = 5
+
+PARTICIPANTS_PER_PAGE = 50
+
+
+# Also drops the event from the document cache, see uwlink/document_cache.py, and marks the user's recommendations for
+# recomputing, see uwlink/recommendations.py
+def _forget(user, event_id):
+    identity_map.discard(User, user.id)
+    identity_map.discard(Event, event_id)
+    document_cache.invalidate(Event, event_id)
+    mark_stale(user.id)
+
+
+def _participant_count(event_id):
+    event = Event._get_collection().find_one({'_id': ObjectId(event_id)}, {'participant_count': 1})
+    if event is None:
+        raise Event.DoesNotExist()
+    return event.get('participant_count', 0)
+
+
+# Adds the user to the event's participants. Returns the new number of participants, or None if the event was created
+# by the user (creators can't join their own events). Raises Event.DoesNotExist if the event doesn't exist, and InvalidId
+# if event_id isn't an id
+def join_event(event_id, user):
+    event_id = ObjectId(event_id)
+    event = Event._get_collection().find_one({'_id': event_id}, {'creator': 1, 'participant_count': 1})
+    if event is None:
+        raise Event.DoesNotExist()
+    if event.get('creator') == user.username:
+        return None
+    try:
+        Membership._get_collection().insert_one({'event_id': event_id, 'user_id': user.id,
+                                                 'joined_at': datetime.now()})
+    except DuplicateKeyError:
+        return event.get('participant_count', 0)
+    event = Event._get_collection().find_one_and_update(
+        {'_id': event_id},
+        {'$inc': {'participant_count': 1, 'version': 1},
+         '$push': {'participant_sample': {'$each': [user.username], '$slice': PARTICIPANT_SAMPLE_SIZE}}},
+        projection={'participant_count': 1},
+        return_document=ReturnDocument.AFTER)
+    _forget(user, event_id)
+    if event is None:
+        # The event was deleted in the meantime
+        Membership._get_collection().delete_one({'event_id': event_id, 'user_id': user.id})
+        raise Event.DoesNotExist()
+    return event['participant_count']
+
+
+# Removes the user from the event's participants. Returns the new number of participants. Raises Event.DoesNotExist if
+# the event doesn't exist, and InvalidId if event_id isn't an id
+def leave_event(event_id, user):
+    event_id = ObjectId(event_id)
+    if Membership._get_collection().delete_one({'event_id': event_id, 'user_id': user.id}).deleted_count == 0:
+        return _participant_count(event_id)
+    event = Event._get_collection().find_one_and_update(
+        {'_id': event_id},
+        {'$inc': {'participant_count': -1, 'version': 1}, '$pull': {'participant_sample': user.username}},
+        projection={'participant_count': 1, 'participant_sample': 1},
+        return_document=ReturnDocument.AFTER)
+    _forget(user, event_id)
+    if event is None:
+        raise Event.DoesNotExist()
+    # If the user was in the sample, the next participant takes their place
+    if len(event.get('participant_sample', [])) < min(event['participant_count'], PARTICIPANT_SAMPLE_SIZE):
+        Event._get_collection().update_one(
+            {'_id': event_id},
+            {'$set': {'participant_sample': participant_page(event_id, 1, PARTICIPANT_SAMPLE_SIZE)},
+             '$inc': {'version': 1}})
+        document_cache.invalidate(Event, event_id)
+    return event['participant_count']
+
+
+# The ids (as strings) of the given events that the user has joined
+def joined_event_ids(user, event_ids):
+    if not event_ids:
+        return set()
+    return {str(membership['event_id']) for membership in Membership._get_collection().find(
+        {'user_id': user.id, 'event_id': {'$in': [ObjectId(event_id) for event_id in event_ids]}}, {'event_id': 1})}
+
+
+# The usernames of the participants on the given page of an event's participants, in the order they joined. Uses the
+# index on (event_id, joined_at)
+def participant_page(event_id, page, per_page=PARTICIPANTS_PER_PAGE):
+    user_ids = [membership['user_id'] for membership in Membership._get_collection()
+                .find({'event_id': ObjectId(event_id)}, {'user_id': 1})
+                .sort('joined_at', 1).skip((page - 1) * per_page).limit(per_page)]
+    users = {user['_id']: user['username']
+             for user in User._get_collection().find({'_id': {'$in': user_ids}}, {'username': 1})}
+    return [users[user_id] for user_id in user_ids if user_id in users]
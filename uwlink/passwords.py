@@ -0,0 +1,108 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing
+#
+# Password hashes are deliberately slow to compute, so that stolen hashes are slow to crack. To keep that work from
+# holding up the web worker (and, with threaded workers, the other requests sharing its interpreter lock), it runs in a
+# small pool of separate processes. At most PASSWORD_HASH_QUEUE_SIZE hashes can be waiting or running per web worker;
+# beyond that, requests fail fast with HashingOverloaded, which the routes turn into a 503 response. So do requests whose
+# hash isn't done after PASSWORD_HASH_TIMEOUT seconds. A hash keeps its place in the queue until it is done or cancelled,
+# even if the request waiting for it has given up, so the pool never has more than PASSWORD_HASH_QUEUE_SIZE hashes
+#
+# The hash method, including the number of iterations, is set with PASSWORD_HASH_METHOD. Stored hashes that were made
+# with a different method are replaced on the user's next successful login
+#
+# https://werkzeug.palletsprojects.com/en/0.16.x/utils/#werkzeug.security.generate_password_hash
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+DEFAULT_CONFIG = {
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:150000',
+    'PASSWORD_HASH_WORKERS': 2,
+    'PASSWORD_HASH_QUEUE_SIZE': 8,
+    'PASSWORD_HASH_TIMEOUT': 10
+}
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+_pool = None
+_slots = None
+_pool_lock = Lock()
+
+
+# The pool is created on first use, i.e. inside each gunicorn worker after it was forked. By then the worker has other
+# threads (gunicorn's, pymongo's), and forking a process with threads can leave the child holding a lock that no thread
+# will ever release, so the pool's processes are started by a forkserver (or spawned where there is none) instead
+#
+# https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+def _get_pool():
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=current_app.config['PASSWORD_HASH_WORKERS'],
+                                        mp_context=multiprocessing.get_context(start_method))
+            if _slots is None:
+                _slots = BoundedSemaphore(current_app.config['PASSWORD_HASH_QUEUE_SIZE'])
+    return _pool, _slots
+
+
+# A pool whose process died (e.g. killed for using too much memory) can't be used again. It is dropped, so that the next
+# hash starts a new one; hashes that were queued in it fail, which releases their slots
+def _drop_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _run(fn, *args):
+    pool, slots = _get_pool()
+    if not slots.acquire(blocking=False):
+        raise HashingOverloaded()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        slots.release()
+        _drop_pool(pool)
+        raise HashingOverloaded()
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda future: slots.release())
+    try:
+        return future.result(timeout=current_app.config['PASSWORD_HASH_TIMEOUT'])
+    except TimeoutError:
+        # A hash that hasn't started yet is dropped from the queue, one that is running keeps its slot until it ends
+        future.cancel()
+        raise HashingOverloaded()
+    except BrokenProcessPool:
+        _drop_pool(pool)
+        raise HashingOverloaded()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(hashed_password, password):
+    return _run(check_password_hash, hashed_password, password)
+
+
+# Whether a stored hash was made with a different method than the configured one. Werkzeug hashes look like
+# method$salt$hash
+def needs_rehash(hashed_password):
+    return hashed_password.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
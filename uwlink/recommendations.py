@@ -0,0 +1,185 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from uwlink.loaders import load_events
+from uwlink.models import User, Event, Membership, Recommendation
+
+# "Recommended for you" events on the feed
+#
+# Recommendations are computed in batches by `flask recommendations build` (every user) and `flask recommendations
+# refresh` (only the users whose participation changed since), which should be run periodically, e.g. from cron or the
+# Heroku Scheduler. The feed then only reads a user's precomputed event ids and loads those events
+#
+# The scores come from tag co-occurrence, computed with sparse matrices:
+#
+#   E  events x tags, 1 where an event has a tag
+#   C  tags x tags, how often two tags are used on the same event, normalized like a cosine similarity so that the most
+#      common tags don't dominate: C = E^T E, C[i][j] / sqrt(C[i][i] * C[j][j])
+#   U  users x tags, how often a user has joined or created an event with a tag
+#   P  users x tags = U C, the user's interest in each tag, including tags that often appear together with theirs
+#
+# and a user's score for an upcoming event is P times the event's (normalized) row of E. Events the user already joined
+# or created are left out, and the RECOMMENDATIONS_PER_USER best ones are kept. Scores are computed for batches of users
+# at a time, sized so that a batch's dense score matrix stays under SCORE_BATCH_CELLS values
+#
+# NumPy and SciPy are only needed for building, and are only imported when it is run
+#
+# https://docs.scipy.org/doc/scipy/reference/sparse.html
+# https://numpy.org/doc/stable/reference/generated/numpy.argpartition.html
+RECOMMENDATIONS_PER_USER = 20
+SCORE_BATCH_CELLS = 10000000
+
+# How many recommendations are shown at the top of the feed
+RECOMMENDED_ON_FEED = 4
+
+
+# Marks the user's recommendations for recomputing by the next refresh. Called whenever the user joins, leaves, creates
+# or deletes an event
+def mark_stale(user_id):
+    Recommendation._get_collection().update_one({'_id': str(user_id)},
+                                                {'$set': {'stale': True, 'changed_at': datetime.now()}},
+                                                upsert=True)
+
+
+def _matrix(rows, cols, shape, dtype):
+    import numpy as np
+    from scipy import sparse
+
+    return sparse.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=shape, dtype=dtype)
+
+
+# Reads every event and membership once, building the coordinates of the sparse matrices described above. users maps
+# each username to the user's id
+class Matrices:
+    def __init__(self, users, now):
+        import numpy as np
+        from scipy import sparse
+
+        self.user_index = {username: index for index, username in enumerate(users)}
+        id_index = {ObjectId(user_id): index for index, user_id in enumerate(users.values())}
+        tags = {}
+        event_rows, event_cols = [], []
+        user_rows, user_cols = [], []
+        upcoming_rows, upcoming_cols = [], []
+        member_rows, member_cols = [], []
+        self.upcoming_ids = []
+        # The tags and upcoming index (or None) of each event, for the pass over the memberships
+        event_info = {}
+        event_count = 0
+        events = Event._get_collection().find({}, {'tags': 1, 'time': 1, 'creator': 1})
+        for event in events:
+            event_index = event_count
+            event_count += 1
+            event_tags = [tags.setdefault(tag, len(tags)) for tag in set(event.get('tags') or [])]
+            event_rows.extend([event_index] * len(event_tags))
+            event_cols.extend(event_tags)
+            upcoming_index = None
+            if event.get('time') and event['time'] >= now and event_tags:
+                upcoming_index = len(self.upcoming_ids)
+                self.upcoming_ids.append(str(event['_id']))
+                upcoming_rows.extend([upcoming_index] * len(event_tags))
+                upcoming_cols.extend(event_tags)
+            event_info[event['_id']] = (event_tags, upcoming_index)
+            creator = self.user_index.get(event.get('creator'))
+            if creator is not None:
+                user_rows.extend([creator] * len(event_tags))
+                user_cols.extend(event_tags)
+                if upcoming_index is not None:
+                    member_rows.append(creator)
+                    member_cols.append(upcoming_index)
+
+        memberships = Membership._get_collection().find({}, {'_id': 0, 'event_id': 1, 'user_id': 1})
+        for membership in memberships:
+            member = id_index.get(membership['user_id'])
+            info = event_info.get(membership['event_id'])
+            if member is None or info is None:
+                continue
+            event_tags, upcoming_index = info
+            user_rows.extend([member] * len(event_tags))
+            user_cols.extend(event_tags)
+            if upcoming_index is not None:
+                member_rows.append(member)
+                member_cols.append(upcoming_index)
+
+        shape = (len(users), len(tags))
+        events = _matrix(event_rows, event_cols, (event_count, len(tags)), np.float32)
+        cooccurrence = (events.T @ events).tocsr()
+        norms = np.sqrt(cooccurrence.diagonal())
+        norms[norms == 0] = 1
+        scale = sparse.diags(1 / norms)
+        self.interests = _matrix(user_rows, user_cols, shape, np.float32) @ (scale @ cooccurrence @ scale)
+
+        upcoming = _matrix(upcoming_rows, upcoming_cols, (len(self.upcoming_ids), len(tags)), np.float32)
+        lengths = np.sqrt(np.asarray(upcoming.sum(axis=1)).ravel())
+        lengths[lengths == 0] = 1
+        self.upcoming = (sparse.diags(1 / lengths) @ upcoming).T.tocsr()
+        self.members = _matrix(member_rows, member_cols, (len(users), len(self.upcoming_ids)), np.int8)
+
+    # The ids of the best upcoming events for each of the given user indexes
+    def top_events(self, user_indexes, count):
+        import numpy as np
+
+        if not self.upcoming_ids:
+            return [[] for _ in user_indexes]
+        scores = (self.interests[user_indexes] @ self.upcoming).toarray()
+        joined = self.members[user_indexes].nonzero()
+        scores[joined] = 0
+        count = min(count, scores.shape[1])
+        best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        results = []
+        for row, candidates in enumerate(best):
+            candidates = candidates[np.argsort(-scores[row, candidates], kind='stable')]
+            results.append([self.upcoming_ids[column] for column in candidates if scores[row, column] > 0])
+        return results
+
+
+# Computes and saves the recommendations of the given users (by id), or of every user. Returns the number of users
+def build(user_ids=None, batch_size=None, progress=None):
+    started = datetime.now()
+    ids = {user['username']: str(user['_id']) for user in User._get_collection().find({}, {'username': 1})}
+    usernames = list(ids)
+    matrices = Matrices(ids, started)
+    if user_ids is None:
+        selected = list(range(len(usernames)))
+    else:
+        user_ids = set(user_ids)
+        selected = [index for index, username in enumerate(usernames) if ids[username] in user_ids]
+    batch_size = batch_size or max(1, SCORE_BATCH_CELLS // max(len(matrices.upcoming_ids), 1))
+    collection = Recommendation._get_collection()
+    for start in range(0, len(selected), batch_size):
+        batch = selected[start:start + batch_size]
+        top_events = matrices.top_events(batch, RECOMMENDATIONS_PER_USER)
+        collection.bulk_write([UpdateOne({'_id': ids[usernames[index]]},
+                                         {'$set': {'event_ids': event_ids, 'computed_at': started, 'stale': False}},
+                                         upsert=True)
+                               for index, event_ids in zip(batch, top_events)], ordered=False)
+        if progress:
+            progress(start + len(batch), len(selected))
+    # Users whose participation changed while this was running still need a refresh
+    collection.update_many({'changed_at': {'$gte': started}}, {'$set': {'stale': True}})
+    return len(selected)
+
+
+# Recomputes the recommendations of the users marked stale. Returns the number of users
+def refresh(batch_size=None, progress=None):
+    user_ids = [recommendation['_id'] for recommendation in
+                Recommendation._get_collection().find({'stale': True}, {'_id': 1})]
+    if not user_ids:
+        return 0
+    return build(user_ids, batch_size, progress)
+
+
+# The recommended events to show the user on the feed: ones that haven't started yet and that the user hasn't joined
+# or created since the recommendations were computed
+def recommended_events(user, fields, limit=RECOMMENDED_ON_FEED):
+    recommendation = Recommendation._get_collection().find_one({'_id': str(user.id)}, {'event_ids': 1})
+    if not recommendation or not recommendation.get('event_ids'):
+        return []
+    event_ids = [event_id for event_id in recommendation['event_ids'] if event_id not in user.events_created]
+    joined = {str(membership['event_id']) for membership in Membership._get_collection().find(
+        {'user_id': user.id, 'event_id': {'$in': [ObjectId(event_id) for event_id in event_ids]}}, {'event_id': 1})}
+    event_ids = [event_id for event_id in event_ids if event_id not in joined]
+    now = datetime.now()
+    events = [event for event in load_events(event_ids[:limit * 2], fields) if event.time and event.time >= now]
+    return events[:limit]
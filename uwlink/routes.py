@@ -1,13 +1,26 @@
 from datetime import datetime, timedelta
 
-from flask import Blueprint, jsonify, request, render_template, flash, redirect, url_for
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import Blueprint, jsonify, request, render_template, flash, redirect, url_for, current_app, make_response, \
+    session, abort
 from flask_login import UserMixin, current_user, login_required, login_user, logout_user
+from mongoengine import Q
 from mongoengine.errors import DoesNotExist
-from uwlink import login_manager, db
+from uwlink import agenda, identity_map, login_manager, db, search_index
+from uwlink.cascades import remove_event_references, rename_user_references
 from uwlink.forms import EventForm, SearchForm, UpdateForm, UpdatePassword
-from uwlink.models import User, Event, Tag
-from werkzeug.security import check_password_hash, generate_password_hash
-from bson.objectid import ObjectId
+from uwlink.fragments import EVENT_CARD_FIELDS, feed_etag
+from uwlink.loaders import count_joined_pages, count_pages, load_event_page, load_events, load_joined_page
+from uwlink.models import User, Event, Job
+from uwlink.pagination import keyset_page, numbered_page
+from uwlink.participation import joined_event_ids, join_event, leave_event, participant_page, \
+    PARTICIPANTS_PER_PAGE
+from uwlink.passwords import HashingOverloaded, hash_password, needs_rehash, verify_password
+from uwlink.recommendations import mark_stale, recommended_events
+from uwlink.search import SearchQuery, find_page, invalidate_results
+from uwlink.sequences import next_created_at
+from uwlink.tags import count_tags, tag_index, trending_tags, uncount_tags
 
 # In Flask, a blueprint is just a group of related routes (the functions below), it helps organize your code
 routes = Blueprint('api', __name__)
@@ -19,6 +32,12 @@ class LoginUser(UserMixin):
         self.user = user
 
 
+# Password hashing is turned away when too many hashes are already queued, see uwlink/passwords.py
+@routes.errorhandler(HashingOverloaded)
+def hashing_overloaded(e):
+    return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}
+
+
 @login_manager.user_loader
 def user_loader(user_id):
     try:
@@ -35,25 +54,22 @@ def user_loader(user_id):
 @routes.route('/signup', methods=['GET', 'POST'])
 def signup():
     form = request.form
-    if request.method == 'POST': 
-        try:
-            if User.objects.get(username=form.get("signupUser")):
-                flash('Username already exist')
-                return redirect(url_for('.login'))
-        except DoesNotExist:
-            pass
-        try:
-            if User.objects.get(email=form.get("signupEmail")):
-                flash('Email already in use')
-                return redirect(url_for('.login'))
-        except DoesNotExist:
-            pass
+    if request.method == 'POST':
+        # One query finds any existing users with the same username or email
+        existing = User.objects(Q(username=form.get("signupUser")) | Q(email=form.get("signupEmail"))) \
+            .only('username', 'email')
+        existing_usernames = [user.username for user in existing]
+        if form.get("signupUser") in existing_usernames:
+            flash('Username already exist')
+            return redirect(url_for('.login'))
+        if existing_usernames:
+            flash('Email already in use')
+            return redirect(url_for('.login'))
         user = User(username=form.get("signupUser"),
                     email=form.get("signupEmail"),
-                    events_joined=[],
                     events_created=[],
                     joined_at=datetime.now(),
-                    hashed_password=generate_password_hash(form.get("signupPassword")))
+                    hashed_password=hash_password(form.get("signupPassword")))
         user.save()
         user = LoginUser(user)
         login_user(user)
@@ -70,7 +86,10 @@ def login():
     if request.method == 'POST':
         try:
             user = User.objects.get(username=form.get("loginUser"))
-            if check_password_hash(user.hashed_password, form.get("loginPassword")):
+            if verify_password(user.hashed_password, form.get("loginPassword")):
+                if needs_rehash(user.hashed_password):
+                    user.hashed_password = hash_password(form.get("loginPassword"))
+                    user.save()
                 user = LoginUser(user)
                 login_user(user)
                 flash('You have logged in!')
@@ -87,7 +106,8 @@ def login():
 def create():
     form = EventForm()
     if form.validate_on_submit():
-        user = User.objects.get(id=current_user.id)
+        # Loaded from MongoDB rather than the document cache, so that the creator is the user's current username
+        user = User.objects.get_fresh(current_user.id)
         form_date = str(form.date.data)
         form_time = str(form.time.data)
         time = datetime.strptime(form_date + form_time, '%Y-%m-%d%H:%M:%S')
@@ -96,43 +116,60 @@ def create():
         for word in content.split():
             if word not in tags:
                 tags.append(word)
-        length = len(list(Event.objects))
-        lastEvent = Event.objects[length - 1]
-        curtime = datetime.now()
-        if curtime < lastEvent.created_at:
-            curtime = lastEvent.created_at + timedelta(seconds=1)
         event = Event(
             name=form.name.data,
             description=form.description.data,
             tags=tags,
             time=time,
             creator=user.username,
-            participants=[],
-            created_at=curtime)
+            created_at=next_created_at(),
+            search_terms=search_index.terms_for(form.name.data))
         event.save()
-        user.events_created.append(str(event.id))
-        user.save()
-        for tag in tags:
-            try:
-                tag = Tag.objects.get(name=tag)
-            except DoesNotExist:
-                tag = Tag(name=tag, events=[])
-            tag.events.append(str(event.id))
-            tag.save()
+        # A $push, so that events created at the same time (e.g. in another worker) are all kept
+        User.objects(id=user.id).update_one(push__events_created=str(event.id))
+        identity_map.forget(User, user.id)
+        count_tags(tags, event.created_at)
+        agenda.count_events([event.time])
+        invalidate_results()
+        mark_stale(user.id)
         flash('Event created successfully!')
         return redirect(url_for('.feed'))
     return render_template('create.html', form=form)
 
 
+# The feed is paged with ?before=<cursor> (older events) and ?after=<cursor> (newer events), see uwlink/pagination.py
+#
+# For anonymous visitors, only the ids and versions of the page's events are loaded at first. If the visitor already
+# has the page (same ETag), the response is an empty 304, otherwise the rest of the events are loaded. See
+# uwlink/fragments.py
 @routes.route('/', methods=['GET'])
 def feed():
-    page = request.args.get('page', 1, type=int)
-    pagination = Event.objects.order_by('-created_at').paginate(page=page, per_page=8)
+    if current_user.is_authenticated:
+        events = Event.objects.only(*EVENT_CARD_FIELDS)
+    else:
+        events = Event.objects.only('id', 'created_at', 'version')
+    if 'page' in request.args:
+        pagination = numbered_page(events, 8, request.args.get('page', 1, type=int))
+    else:
+        pagination = keyset_page(events, 8, before=request.args.get('before'), after=request.args.get('after'))
     if current_user.is_authenticated:
         user = User.objects.get(id=current_user.id)
-        return render_template('feed.html', pagination=pagination,
-                                user=User.objects.get(id=current_user.id))
-    return render_template('feed.html', pagination=pagination, user=None)
+        # Recommendations are only shown above the newest events, see uwlink/recommendations.py
+        recommended = []
+        if not request.args:
+            recommended = recommended_events(user, EVENT_CARD_FIELDS)
+        return render_template('feed.html', pagination=pagination, user=user, recommended=recommended,
+                               joined=joined_ids(user, pagination.items, recommended))
+    etag = feed_etag(current_app, pagination)
+    # Flashed messages are shown once, so a page with a pending message always has to be rendered
+    if request.if_none_match.contains_weak(etag) and not session.get('_flashes'):
+        response = make_response('', 304)
+    else:
+        pagination.items = load_events([str(event.id) for event in pagination.items], EVENT_CARD_FIELDS)
+        response = make_response(render_template('feed.html', pagination=pagination, user=None, joined=set()))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 # search events
@@ -140,164 +177,65 @@ def feed():
 def search():
     form = SearchForm()
     if form.validate_on_submit():
-        data = [None] * 5
-        data[0] = form.name.data
-        data[1] = form.tags.data
-        data[2] = form.date_from.data
-        data[3] = form.date_to.data
-        data[4] = form.display_past_events.data
-        return redirect(url_for('.result', data=data))
+        query = SearchQuery.from_form(form)
+        return redirect(url_for('.result', **query.to_args()))
     return render_template('search.html', form=form)
 
 
 events_per_page = 8
 
 
-# display search results for the given data      
-@routes.route('/result/<data>/', methods=['GET'])
-def result(data):
-    content = data.strip('][').split(', ')
-    fields = [None] * len(content)
-    for i in range(0,2):
-        fields[i] = content[i][1:len(content[i])-1]
-    for i in range(2,len(content)):
-        fields[i] = content[i]
-    event_list = []
-    if fields[0] == "" and fields[1] == "":
-        event_list = list(Event.objects)
-    else:
-        search_names = fields[0]
-        search_tags = fields[1]
-        # and search for event names (>= 2/3 matching)
-        names = []
-        for name in search_names.split():
-            if name not in names:
-                names.append(name)
-        if len(names) > 0:
-            for event in list(Event.objects):
-                count = 0
-                for name in names:
-                    if name in event.name:
-                        count += 1
-                if count >= 2/3 * len(names):
-                    event_list.append(event)
-        # or search for event tags
-        tags = []
-        for tag in search_tags.split():
-            if tag not in tags:
-                tags.append(tag)
-        for tag in tags:
-            try:
-                TAG = Tag.objects.get(name=tag)
-                events = TAG.events
-                for event_id in events:
-                    event = Event.objects.get(id=ObjectId(event_id))
-                    if event not in event_list:
-                        event_list.append(event)
-            except DoesNotExist:
-                pass
-    # filters by time
-    event_list.sort(key=lambda event: event.time, reverse=True)
-    idx = 2
-    if fields[idx] != 'None':
-        search_time = fields[idx][14:] + '-' + fields[idx+1] + '-' + fields[idx+2][0:len(fields[idx+2])-1]
-        time_from = datetime.strptime(search_time, '%Y-%m-%d')
-        newlist = []
-        for event in event_list:
-            if event.time.date() >= time_from.date():
-                newlist.append(event)
-            else:
-                break
-        event_list = newlist
-        idx += 3
-    else:
-        idx += 1
-    if fields[idx] != 'None':
-        event_list.reverse()
-        search_time = fields[idx][14:] + '-' + fields[idx+1] + '-' + fields[idx+2][0:len(fields[idx+2])-1]
-        time_to = datetime.strptime(search_time, '%Y-%m-%d')
-        newlist = []
-        for event in event_list:
-            if event.time.date() <= time_to.date():
-                newlist.append(event)
-            else:
-                break
-        event_list = newlist
-        idx += 3
-        event_list.reverse()
-    else:
-        idx += 1
-    if fields[idx] == 'False':
-        time = datetime.now()
-        newlist = []
-        for event in event_list:
-            if event.time >= time:
-                newlist.append(event)
-            else:
-                break
-        event_list = newlist
-    event_list.reverse()
-    page = request.args.get('page', 1, type=int)
-    if len(event_list) == 0:
-        if current_user.is_authenticated:
-            return render_template('result.html', event_list=event_list, page=page,
-                                    page_count=0, data=data, user=User.objects.get(id=current_user.id))
-        else:
-            return render_template('result.html', event_list=event_list, page=page,
-                                    page_count=0, data=data, user=None)
-    pages = []
-    idx = 0
-    for i in range(0, len(event_list), events_per_page):
-        pages.append(event_list[i:i+events_per_page])
-        pages[idx].sort(key=lambda event: event.time, reverse=True)
-        idx += 1
-    page_count = len(pages)
+# display search results for the query in the query string, see uwlink/search.py
+@routes.route('/result', methods=['GET'])
+def result():
+    query = SearchQuery.from_args(request.args)
+    page = max(request.args.get('page', 1, type=int), 1)
+    event_list, count = find_page(query, page, events_per_page)
+    page_count = (count + events_per_page - 1) // events_per_page
     if current_user.is_authenticated:
-        return render_template('result.html', event_list=pages[page - 1], page=page,
-                                page_count=page_count, data=data, user=User.objects.get(id=current_user.id))
+        user = User.objects.get(id=current_user.id)
+        return render_template('result.html', event_list=event_list, page=page,
+                                page_count=page_count, query_args=query.to_args(),
+                                user=user, joined=joined_ids(user, event_list))
     else:
-        return render_template('result.html', event_list=pages[page - 1], page=page, 
-                                page_count=page_count, data=data, user=None)
+        return render_template('result.html', event_list=event_list, page=page,
+                                page_count=page_count, query_args=query.to_args(), user=None, joined=set())
 
 
+# Results pages used to be at /result/<data>/, with the search encoded in the path
+@routes.route('/result/<data>/', methods=['GET'])
+def legacy_result(data):
+    return redirect(url_for('.search'))
+
+
+profile_events_per_page = 4
+
+
+# The ids of the given events that the user joined, for the Join/Leave buttons, in one query. See
+# uwlink/participation.py
+def joined_ids(user, *event_lists):
+    return joined_event_ids(user, [str(event.id) for events in event_lists for event in events])
+
+
+# The profile pages show one page of the events a user created and one page of the events they joined, see
+# uwlink/loaders.py
 @routes.route('/profile/<username>', methods=['GET', 'POST'])
 def profile(username):
     user = User.objects.get(username=username)
-    events_created = []
-    for event_id in user.events_created:
-        event = Event.objects.get(id=event_id)
-        events_created.append(event)
-    events_joined = []
-    for event_id in user.events_joined:
-        event = Event.objects.get(id=event_id)
-        events_joined.append(event)
-    events_created.reverse()
-    events_joined.reverse()
-    page = request.args.get('page', 1, type=int)
-    created_pages = []
-    c_idx = 0
-    for i in range(0, len(events_created), 4):
-        created_pages.append(events_created[i:i+4])
-        c_idx += 1
-    created_page = []
-    if page <= len(created_pages):
-        created_page = created_pages[page - 1]
-    joined_pages = []
-    j_idx = 0
-    for i in range(0, len(events_joined), 4):
-        joined_pages.append(events_joined[i:i+4])
-        j_idx += 1
-    joined_page = []
-    if page <= len(joined_pages):
-        joined_page = joined_pages[page - 1]
-    page_count = max(len(joined_pages), len(created_pages))
+    page = max(request.args.get('page', 1, type=int), 1)
+    created_page = load_event_page(user.events_created, page, profile_events_per_page)
+    joined_page = load_joined_page(user.id, page, profile_events_per_page)
+    page_count = max(count_pages(user.events_created, profile_events_per_page),
+                     count_joined_pages(user.id, profile_events_per_page))
     if current_user.is_authenticated:
+        viewer = User.objects.get(id=current_user.id)
         return render_template('profile.html', name = user.username,
                                 email = user.email,
                                 join = user.joined_at,
                                 events_created = created_page,
                                 events_joined = joined_page,
-                                user = User.objects.get(id=current_user.id),
+                                user = viewer,
+                                joined = joined_ids(viewer, created_page, joined_page),
                                 page_count = page_count,
                                 page = page,
                                 account = False)
@@ -308,6 +246,7 @@ def profile(username):
                                 events_created = created_page,
                                 events_joined = joined_page,
                                 user = None,
+                                joined = set(),
                                 page_count = page_count,
                                 page = page,
                                 account = False)
@@ -316,60 +255,63 @@ def profile(username):
 @routes.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
-    events_created = []
-    for event_id in current_user.user.events_created:
-        event = Event.objects.get(id = event_id)
-        events_created.append(event)
-    events_joined = []
-    for event_id in current_user.user.events_joined:
-        event = Event.objects.get(id = event_id)
-        events_joined.append(event)
-    events_created.reverse()
-    events_joined.reverse()
-    page = request.args.get('page', 1, type=int)
-    created_pages = []
-    c_idx = 0
-    for i in range(0, len(events_created), 4):
-        created_pages.append(events_created[i:i+4])
-        c_idx += 1
-    created_page = []
-    if page <= len(created_pages):
-        created_page = created_pages[page - 1]
-    joined_pages = []
-    j_idx = 0
-    for i in range(0, len(events_joined), 4):
-        joined_pages.append(events_joined[i:i+4])
-        j_idx += 1
-    joined_page = []
-    if page <= len(joined_pages):
-        joined_page = joined_pages[page - 1]
-    page_count = max(len(joined_pages), len(created_pages))
+    user = current_user.user
+    page = max(request.args.get('page', 1, type=int), 1)
+    created_page = load_event_page(user.events_created, page, profile_events_per_page)
+    joined_page = load_joined_page(user.id, page, profile_events_per_page)
+    page_count = max(count_pages(user.events_created, profile_events_per_page),
+                     count_joined_pages(user.id, profile_events_per_page))
     return render_template('profile.html', name = current_user.user.username,
                             email = current_user.user.email,
                             join = current_user.user.joined_at,
                             events_created = created_page,
                             events_joined = joined_page,
+                            joined = {str(event.id) for event in joined_page},
                             page_count = page_count,
                             page = page,
                             user = User.objects.get(id=current_user.id),
                             account = True)
 
 
+# Scripts can ask for the new participant count as JSON instead of being redirected back to the feed
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+
+# Fan-outs that touch many documents run as background jobs, see uwlink/cascades.py. The user is told where to follow
+# the job's progress
+def job_url(job):
+    return url_for('.job', job_id=str(job.id)) if job is not None else None
+
+
+def flash_job(job):
+    if job is not None:
+        flash('Some changes are still being made in the background, see {} for their progress'.format(job_url(job)))
+
+
+# For events that don't exist, e.g. because they were deleted after the page was loaded, or malformed event ids
+def event_not_found():
+    if wants_json():
+        return jsonify(error='Event not found'), 404
+    abort(404)
+
+
+# join and leave are single atomic updates, see uwlink/participation.py
 @routes.route('/join', methods=['POST'])
 @login_required
 def join():
     event_id = request.form.get("event_id")
-    event = Event.objects.get(id=event_id)
-    user = User.objects.get(id=current_user.id)
-    if event.creator == user.username:
+    try:
+        participant_count = join_event(event_id, current_user.user)
+    except (InvalidId, DoesNotExist):
+        return event_not_found()
+    if participant_count is None:
         flash('Sorry, you cannot join an event that you created')
     else:
-        user = User.objects.get(id=current_user.id)
-        user.events_joined.append(str(event.id))
-        user.save()
-        event.participants.append(str(user.username))
-        event.save()
+        invalidate_results()
         flash('Joined!')
+    if wants_json():
+        return jsonify(event_id=event_id, participant_count=participant_count)
     return redirect(url_for('.feed'))
 
 
@@ -377,13 +319,14 @@ def join():
 @login_required
 def leave():
     event_id = request.form.get("event_id")
-    event = Event.objects.get(id=event_id)
-    user = User.objects.get(id=current_user.id)
-    user.events_joined.remove(str(event.id))
-    user.save()
-    event.participants.remove(str(user.username))
-    event.save()
+    try:
+        participant_count = leave_event(event_id, current_user.user)
+    except (InvalidId, DoesNotExist):
+        return event_not_found()
+    invalidate_results()
     flash('Left!')
+    if wants_json():
+        return jsonify(event_id=event_id, participant_count=participant_count)
     return redirect(url_for('.feed'))
 
 
@@ -391,24 +334,97 @@ def leave():
 @login_required
 def delete():
     event_id = request.form.get("event_id")
-    event = Event.objects.get(id=event_id)
-    user = User.objects.get(id=current_user.id)
-    user.events_created.remove(str(event.id))
-    user.save()
-    for participant_name in event.participants:
-        participant = User.objects.get(username=participant_name)
-        participant.events_joined.remove(str(event_id))
-        participant.save()
-    for tag_name in event.tags:
-        tag = Tag.objects.get(name=tag_name)
-        tag.events.remove(str(event_id))
-        tag.save()
-    event.save()
+    try:
+        event = Event.objects.get_fresh(ObjectId(event_id))
+    except (InvalidId, DoesNotExist):
+        return event_not_found()
+    user = current_user.user
+    # Only the user who created the event can delete it. The $pull only matches if the event is one of theirs
+    if not User.objects(id=user.id, events_created=str(event.id)).update_one(pull__events_created=str(event.id)):
+        abort(403)
+    identity_map.forget(User, user.id)
+    # The event's memberships are removed in bulk, see uwlink/cascades.py
+    job = remove_event_references(event.id, event.participant_count, user.id)
+    uncount_tags(event.tags)
     event.delete()
+    agenda.count_events([event.time], -1)
+    invalidate_results()
+    mark_stale(user.id)
     flash('Deleted!')
+    flash_job(job)
+    if wants_json():
+        return jsonify(event_id=event_id, job_url=job_url(job))
     return redirect(url_for('.feed'))
 
 
+# Everyone taking part in an event, PARTICIPANTS_PER_PAGE at a time. Event cards only show the first few
+@routes.route('/event/<event_id>/participants', methods=['GET'])
+def participants(event_id):
+    event = Event.objects.only('name', 'creator', 'participant_count').get_or_404(id=event_id)
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_count = max((event.participant_count + PARTICIPANTS_PER_PAGE - 1) // PARTICIPANTS_PER_PAGE, 1)
+    user = User.objects.get(id=current_user.id) if current_user.is_authenticated else None
+    return render_template('participants.html', event=event, participants=participant_page(event.id, page),
+                           page=page, page_count=page_count, user=user)
+
+
+def _parse_day(value, default):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return default
+
+
+# The calendar of events, see uwlink/agenda.py. The month view shows the number of events on each day of the month and
+# lists the events of the selected day, the week view lists the first few events of each day of the week
+@routes.route('/calendar', methods=['GET'])
+def calendar():
+    day = _parse_day(request.args.get('day'), datetime.now().date())
+    if request.args.get('view') == 'week':
+        days = [agenda.week_start(day) + timedelta(days=offset) for offset in range(7)]
+        counts = agenda.day_counts(days[0], days[-1] + timedelta(days=1))
+        events = agenda.week_events(days[0]) if counts else {}
+        return render_template('calendar.html', view='week', day=day, days=days, counts=counts, events=events,
+                               earlier=day - timedelta(days=7), later=day + timedelta(days=7))
+    weeks = agenda.month_weeks(day.year, day.month)
+    first = day.replace(day=1)
+    counts = agenda.day_counts(weeks[0][0], weeks[-1][-1] + timedelta(days=1))
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_count = (counts.get(day, 0) + agenda.CALENDAR_EVENTS_PER_PAGE - 1) // agenda.CALENDAR_EVENTS_PER_PAGE
+    events = agenda.events_on(day, page) if counts.get(day) else []
+    return render_template('calendar.html', view='month', day=day, weeks=weeks, counts=counts, events=events,
+                           page=page, page_count=page_count, earlier=(first - timedelta(days=1)).replace(day=1),
+                           later=(first + timedelta(days=31)).replace(day=1))
+
+
+# The status of a background job started by one of the routes above, see uwlink/jobs.py. Other users' jobs are answered
+# like jobs that don't exist
+@routes.route('/job/<job_id>', methods=['GET'])
+@login_required
+def job(job_id):
+    if not ObjectId.is_valid(job_id):
+        abort(404)
+    return jsonify(Job.objects.get_or_404(id=job_id, owner=str(current_user.id)).to_dict())
+
+
+# Tag suggestions for the event form, from the in-memory index in uwlink/tags.py
+@routes.route('/api/tags/complete', methods=['GET'])
+def complete_tags():
+    prefix = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    if not prefix:
+        return jsonify(tags=[])
+    return jsonify(tags=[{'name': name, 'event_count': count} for name, count in tag_index.complete(prefix, limit)])
+
+
+# The tags used by the most events created in the last `days` days
+@routes.route('/api/tags/trending', methods=['GET'])
+def trending():
+    days = min(max(request.args.get('days', 7, type=int), 1), 90)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify(days=days, tags=[{'name': name, 'event_count': count} for name, count in trending_tags(days, limit)])
+
+
 @routes.route("/logout")
 @login_required
 def logout():
@@ -421,36 +437,34 @@ def logout():
 def update():
     form1 = UpdateForm()
     form2 = UpdatePassword()
+    # The user is loaded from MongoDB rather than the document cache, see get_fresh in uwlink/identity_map.py
     if form1.submit1.data and form1.validate_on_submit():
-        user = User.objects.get(id=current_user.id)
-        if form1.username.data != user.username:
-            oldname = user.username
-            user.username = form1.username.data
-            for event_id in user.events_created:
-                event = Event.objects.get(id=event_id)
-                event.creator = user.username
-                event.save()
-            for event_id in user.events_joined:
-                event = Event.objects.get(id=event_id)
-                event.participants = [user.username if name == oldname else name for name in event.participants]
-                event.save()
+        user = User.objects.get_fresh(current_user.id)
+        oldname = user.username
+        user.username = form1.username.data
         user.email = form1.email.data
         user.save()
+        # The events the user created and joined are updated in bulk, see uwlink/cascades.py
+        job = None
+        if user.username != oldname:
+            job = rename_user_references(oldname, user.username, user.id, user.events_created)
+        invalidate_results()
         flash('Your account has been updated')
+        flash_job(job)
         return redirect(url_for('.update'))
     if form2.submit2.data and form2.validate_on_submit():
-        user = User.objects.get(id=current_user.id)
-        if check_password_hash(user.hashed_password, form2.oldpassword.data) and form2.newpassword.data == form2.confirmpassword.data:
-            user.hashed_password = generate_password_hash(form2.newpassword.data)
-            user.save()
-            flash('Your password has been changed')
-            return redirect(url_for('.update'))
-        elif not check_password_hash(user.hashed_password, form2.oldpassword.data):
+        user = User.objects.get_fresh(current_user.id)
+        if not verify_password(user.hashed_password, form2.oldpassword.data):
             flash('You entered the wrong old password')
             return redirect(url_for('.update'))
         elif form2.newpassword.data != form2.confirmpassword.data:
             flash('You passwords do not match')
             return redirect(url_for('.update'))
+        else:
+            user.hashed_password = hash_password(form2.newpassword.data)
+            user.save()
+            flash('Your password has been changed')
+            return redirect(url_for('.update'))
     user = User.objects.get(id=current_user.id)
     form1.username.data = user.username
     form1.email.data = user.email
@@ -0,0 +1,137 @@
+from datetime import date, datetime, timedelta
+from threading import Lock
+
+from cachetools import TTLCache
+from uwlink import search_index
+from uwlink.models import Event
+
+# Event search, as used by the /search and /result pages
+#
+# A search is described by a SearchQuery, which is passed between pages as query string parameters, e.g.
+#
+#   /result?name=board+games&tags=social&date_from=2021-07-01&past=1&page=2
+#
+# Queries are normalized (words and tags deduplicated and sorted, dates in ISO format) so that searches that differ
+# only in word order share an entry in the result cache below
+
+
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+class SearchQuery:
+    def __init__(self, names=(), tags=(), date_from=None, date_to=None, past=False):
+        self.names = sorted(set(names))
+        self.tags = sorted(set(tags))
+        self.date_from = date_from
+        self.date_to = date_to
+        self.past = bool(past)
+
+    @classmethod
+    def from_form(cls, form):
+        return cls(names=(form.name.data or '').split(),
+                   tags=(form.tags.data or '').split(),
+                   date_from=form.date_from.data,
+                   date_to=form.date_to.data,
+                   past=form.display_past_events.data)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(names=args.get('name', '').split(),
+                   tags=args.get('tags', '').split(),
+                   date_from=_parse_date(args.get('date_from')),
+                   date_to=_parse_date(args.get('date_to')),
+                   past=args.get('past') == '1')
+
+    # Query string parameters for url_for, the inverse of from_args. Empty parameters are left out
+    def to_args(self):
+        args = {}
+        if self.names:
+            args['name'] = ' '.join(self.names)
+        if self.tags:
+            args['tags'] = ' '.join(self.tags)
+        if self.date_from:
+            args['date_from'] = self.date_from.isoformat()
+        if self.date_to:
+            args['date_to'] = self.date_to.isoformat()
+        if self.past:
+            args['past'] = '1'
+        return args
+
+    def key(self):
+        return (tuple(self.names), tuple(self.tags), self.date_from, self.date_to, self.past)
+
+    # The raw MongoDB query for the matching events: the name and tag search from uwlink/search_index.py, plus a range
+    # on the indexed Event.time field for the date filters
+    def to_mongo(self):
+        query = search_index.match_query(self.names, self.tags)
+        time_range = {}
+        if self.date_from:
+            time_range['$gte'] = datetime.combine(self.date_from, datetime.min.time())
+        if self.date_to:
+            time_range['$lt'] = datetime.combine(self.date_to, datetime.min.time()) + timedelta(days=1)
+        if not self.past:
+            now = datetime.now()
+            if '$gte' not in time_range or time_range['$gte'] < now:
+                time_range['$gte'] = now
+        if not time_range:
+            return query
+        if not query:
+            return {'time': time_range}
+        return {'$and': [query, {'time': time_range}]}
+
+
+# Recent search results, as (event count, ids of the first CACHED_RESULTS events in display order), keyed by
+# SearchQuery.key(). Entries are evicted least recently used first, and expire after RESULT_CACHE_TTL seconds
+#
+# Every gunicorn worker has its own cache. Writes clear the cache of the worker handling them, and other workers pick
+# up the change when their entries expire
+#
+# https://cachetools.readthedocs.io/en/stable/#cachetools.TTLCache
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 60
+CACHED_RESULTS = 400
+
+result_cache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+result_cache_lock = Lock()
+
+
+# Called by every route that creates, deletes or changes events
+def invalidate_results():
+    with result_cache_lock:
+        result_cache.clear()
+
+
+def _cached_results(query):
+    key = query.key()
+    with result_cache_lock:
+        entry = result_cache.get(key)
+    if entry is None:
+        events = Event.objects(__raw__=query.to_mongo()).order_by('time', 'id')
+        event_ids = list(events.limit(CACHED_RESULTS).scalar('id'))
+        count = len(event_ids) if len(event_ids) < CACHED_RESULTS else events.count()
+        entry = (count, event_ids)
+        with result_cache_lock:
+            result_cache[key] = entry
+    return entry
+
+
+# The Event fields shown on the results page. search_terms in particular is left out, it is many times the size of the
+# rest of the event
+RESULT_EVENT_FIELDS = ('name', 'description', 'time', 'creator', 'participant_count', 'participant_sample')
+
+
+# Returns (events on the given page, earliest first, total number of matching events). Pages within the cached ids only
+# load the events on that page, pages past them fall back to skip/limit
+def find_page(query, page, per_page, fields=RESULT_EVENT_FIELDS):
+    count, event_ids = _cached_results(query)
+    start = (page - 1) * per_page
+    if start + per_page <= len(event_ids) or len(event_ids) == count:
+        page_ids = event_ids[start:start + per_page]
+        events = {event.id: event for event in Event.objects(id__in=page_ids).only(*fields)}
+        return [events[event_id] for event_id in page_ids if event_id in events], count
+    events = Event.objects(__raw__=query.to_mongo()).only(*fields).order_by('time', 'id')
+    return list(events.skip(start).limit(per_page)), count
@@ -0,0 +1,69 @@
+import re
+
+# Search index for event names
+#
+# Searching used to load every event and check each search word against each event name with Python's `in`. Instead,
+# every event stores the short substrings ("grams") of the words in its name in Event.search_terms. MongoDB keeps a
+# multikey index on that field, which is an inverted index: for every gram it holds the postings list of the events
+# containing it. The index is shared by every gunicorn worker, and MongoDB updates it whenever an event is saved or
+# deleted, so the routes only have to fill in search_terms when an event's name is set
+#
+# https://docs.mongodb.com/manual/core/index-multikey/
+# https://en.wikipedia.org/wiki/Inverted_index
+GRAM_SIZE = 3
+
+
+# Every substring of 1 to GRAM_SIZE characters of every word in the name. Search words never contain whitespace, so a
+# search word that occurs in a name always occurs inside a single word of that name
+def terms_for(name):
+    terms = set()
+    for word in (name or '').split():
+        for size in range(1, GRAM_SIZE + 1):
+            for i in range(len(word) - size + 1):
+                terms.add(word[i:i + size])
+    return sorted(terms)
+
+
+# Short words are indexed as they are. Longer words are looked up by all of their GRAM_SIZE-long substrings, and the
+# events found that way are then checked against the whole word
+def _word_query(word):
+    if len(word) <= GRAM_SIZE:
+        return {'search_terms': word}
+    grams = sorted(set(word[i:i + GRAM_SIZE] for i in range(len(word) - GRAM_SIZE + 1)))
+    return {'search_terms': {'$all': grams}, 'name': {'$regex': re.escape(word)}}
+
+
+# An event matches the name search if at least 2/3 of the search words occur in its name
+def _name_query(names):
+    clauses = [_word_query(name) for name in names]
+    needed = (2 * len(names) + 2) // 3
+    if len(clauses) == 1:
+        return clauses[0]
+    if needed == len(clauses):
+        return {'$and': clauses}
+    # Candidates must contain at least one search word, which the index can answer. Only those candidates are
+    # counted against the threshold
+    hits = [{'$cond': [{'$regexMatch': {'input': '$name', 'regex': re.escape(name)}}, 1, 0]} for name in names]
+    return {'$and': [{'$or': clauses}, {'$expr': {'$gte': [{'$add': hits}, needed]}}]}
+
+
+# Served by the multikey index on Event.tags
+def _tag_query(tags):
+    return {'tags': {'$in': tags}}
+
+
+# Returns a raw MongoDB query for the events matching the given (deduplicated) search words and tags: events whose name
+# matches the name search OR that have one of the tags. No words and no tags match every event
+#
+# https://docs.mongoengine.org/guide/querying.html#raw-queries
+def match_query(names, tags):
+    clauses = []
+    if names:
+        clauses.append(_name_query(names))
+    if tags:
+        clauses.append(_tag_query(tags))
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from uwlink.models import Counter, Event
+
+# Event.created_at values are strictly increasing, so that the feed has a stable order even when two events are posted
+# in the same millisecond. The last value handed out is kept in a Counter document and advanced with a single atomic
+# update, so concurrent requests (in any gunicorn worker) never get the same value and never need to look at the events
+# collection
+#
+# https://docs.mongodb.com/manual/reference/method/db.collection.findOneAndUpdate/
+# https://docs.mongodb.com/manual/tutorial/update-documents-with-aggregation-pipeline/
+CREATED_AT_COUNTER = 'event_created_at'
+
+
+# Returns the current time, or 1 millisecond after the last value handed out if that is later (MongoDB stores times
+# with millisecond precision)
+def next_created_at():
+    now = datetime.now()
+    counter = Counter._get_collection().find_one_and_update(
+        {'_id': CREATED_AT_COUNTER},
+        [{'$set': {'value': {'$cond': [{'$gt': [now, '$value']}, now, {'$add': ['$value', 1]}]}}}],
+        return_document=ReturnDocument.AFTER)
+    if counter is None:
+        _create_counter()
+        return next_created_at()
+    return counter['value']
+
+
+# The counter starts at the created_at of the newest existing event. If two requests get here at the same time, one of
+# them creates the counter and the other one's insert is rejected by the unique _id, which is fine
+def _create_counter():
+    newest = Event.objects.order_by('-created_at').only('created_at').first()
+    try:
+        Counter._get_collection().insert_one({'_id': CREATED_AT_COUNTER,
+                                              'value': newest.created_at if newest else datetime.min})
+    except DuplicateKeyError:
+        pass
@@ -0,0 +1,118 @@
+import time
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from threading import Lock
+
+from cachetools import TTLCache, cached
+from pymongo import UpdateOne
+from uwlink.models import Event, Tag
+
+# Tag usage counts
+#
+# Each Tag document counts the events using that tag. Counts are changed with $inc, so concurrent creates and deletes
+# never overwrite each other, and a tag's document is created the first time it is used (upsert)
+#
+# https://docs.mongodb.com/manual/reference/operator/update/inc/
+# https://docs.mongodb.com/manual/reference/method/db.collection.bulkWrite/
+#
+# Each worker also keeps every tag name and count in memory, for autocompleting tags as they are typed (see
+# TagIndex below), and caches the trending tags for a minute
+#
+# https://docs.python.org/3/library/bisect.html
+TAG_INDEX_MAX_AGE = 300
+TRENDING_WINDOW_DAYS = 7
+TRENDING_CACHE_SECONDS = 60
+
+
+# Tag names sorted case-insensitively, so that all the tags starting with a prefix are next to each other and are
+# found with a binary search. The index is loaded from the tags collection on first use, and reloaded every
+# TAG_INDEX_MAX_AGE seconds to pick up tags counted by other workers; this worker's own changes are applied right away
+class TagIndex:
+    def __init__(self, max_age=TAG_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self.lock = Lock()
+        self.entries = []
+        self.counts = {}
+        self.loaded_at = None
+
+    def _load(self):
+        counts = {tag['name']: tag['event_count']
+                  for tag in Tag._get_collection().find({'event_count': {'$gt': 0}}, {'name': 1, 'event_count': 1})}
+        entries = sorted((name.lower(), name) for name in counts)
+        with self.lock:
+            self.counts = counts
+            self.entries = entries
+            self.loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age:
+            self._load()
+
+    def add(self, tags, change=1):
+        if self.loaded_at is None:
+            return
+        with self.lock:
+            for tag in tags:
+                count = self.counts.get(tag, 0) + change
+                index = bisect_left(self.entries, (tag.lower(), tag))
+                present = index < len(self.entries) and self.entries[index] == (tag.lower(), tag)
+                if count > 0:
+                    self.counts[tag] = count
+                    if not present:
+                        self.entries.insert(index, (tag.lower(), tag))
+                else:
+                    self.counts.pop(tag, None)
+                    if present:
+                        del self.entries[index]
+
+    def remove(self, tags):
+        self.add(tags, -1)
+
+    # The most used tags starting with prefix (ignoring case), as (name, event count)
+    def complete(self, prefix, limit=10):
+        self._ensure_loaded()
+        prefix = prefix.lower()
+        with self.lock:
+            matches = []
+            for key, name in self.entries[bisect_left(self.entries, (prefix,)):]:
+                if not key.startswith(prefix):
+                    break
+                matches.append((name, self.counts[name]))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit]
+
+
+tag_index = TagIndex()
+
+
+# Adds 1 to the counts of the given tags, for a newly created event
+def count_tags(tags, when=None):
+    if not tags:
+        return
+    when = when or datetime.now()
+    Tag._get_collection().bulk_write([UpdateOne({'name': tag},
+                                                {'$inc': {'event_count': 1}, '$max': {'last_used': when}},
+                                                upsert=True)
+                                      for tag in tags], ordered=False)
+    tag_index.add(tags)
+
+
+# Subtracts 1 from the counts of the given tags, for a deleted event
+def uncount_tags(tags):
+    if not tags:
+        return
+    Tag._get_collection().update_many({'name': {'$in': list(tags)}}, {'$inc': {'event_count': -1}})
+    tag_index.remove(tags)
+
+
+# The tags used by the most events created in the last `days` days, as (name, event count). Uses the index on
+# created_at
+@cached(TTLCache(maxsize=32, ttl=TRENDING_CACHE_SECONDS), lock=Lock())
+def trending_tags(days=TRENDING_WINDOW_DAYS, limit=10):
+    since = datetime.now() - timedelta(days=days)
+    return [(tag['_id'], tag['event_count']) for tag in Event._get_collection().aggregate([
+        {'$match': {'created_at': {'$gte': since}}},
+        {'$unwind': '$tags'},
+        {'$group': {'_id': '$tags', 'event_count': {'$sum': 1}}},
+        {'$sort': {'event_count': -1, '_id': 1}},
+        {'$limit': limit}])]